@@ -5,6 +5,9 @@ import java.awt.image.BufferedImage
 import qupath.lib.images.servers.ImageServerProvider
 import qupath.opencv.ops.ImageOps
 import qupath.lib.common.ThreadTools
+import qupath.lib.objects.PathObjects
+import qupath.lib.regions.ImagePlane
+import qupath.lib.roi.ROIs
 
 println 'Starting StarDist cell segmentation'
 
@@ -36,6 +39,14 @@ def pixelSize = server.getPixelCalibration().getAveragedPixelSize()
 // Log the pixel size
 println "Pixel size from image metadata: ${pixelSize}"
 
+// Save the calibration used for the measurements, which converts
+// their coordinates (in microns, if the image is calibrated) back to pixels
+new File(args[13]).text = groovy.json.JsonOutput.toJson([
+    pixel_size: pixelSize,
+    unit: server.getPixelCalibration().getPixelWidthUnit(),
+    has_microns: server.getPixelCalibration().hasPixelSizeMicrons()
+])
+
 // Normalization approach follows https://qupath.readthedocs.io/en/stable/docs/deep/stardist.html#improving-input-normalization
 def stardist = StarDist2D
         .builder(args[0])
@@ -55,7 +66,20 @@ def stardist = StarDist2D
         .includeProbability(true)    // Add probability as a measurement (enables later filtering)
         .build()
 
-def pathObjects = createFullImageAnnotation(imageData, true)
+// Detect cells in the whole image, or only in one tile (with its halo)
+// given as "y0,x0,y1,x1" in pixels
+def tileBounds = args.length > 12 ? args[12] : "full"
+def pathObjects
+if (tileBounds == "full") {
+    pathObjects = createFullImageAnnotation(imageData, true)
+} else {
+    def (y0, x0, y1, x1) = tileBounds.split(",").collect { it as int }
+    println "Detecting cells in tile: x=${x0}, y=${y0}, width=${x1 - x0}, height=${y1 - y0}"
+    pathObjects = PathObjects.createAnnotationObject(
+        ROIs.createRectangleROI(x0, y0, x1 - x0, y1 - y0, ImagePlane.getDefaultPlane())
+    )
+    imageData.getHierarchy().addObject(pathObjects)
+}
 
 stardist.detectObjects(imageData, pathObjects, true)
 entry.saveImageData(imageData)
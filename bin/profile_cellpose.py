@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import json
+import logging
+import math
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+from tifffile import TiffFile
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def count_tiles(height: int, width: int, bsize=224, tile_overlap=0.1) -> int:
+    """
+    Count the tiles which cellpose runs through the network for an image
+    (without augmentation), as in cellpose.transforms.make_tiles.
+    """
+    tile_overlap = min(0.5, max(0.05, tile_overlap))
+    ny = 1 if height <= bsize else int(math.ceil((1. + 2 * tile_overlap) * height / bsize))
+    nx = 1 if width <= bsize else int(math.ceil((1. + 2 * tile_overlap) * width / bsize))
+    return ny * nx
+
+
+def read_shapes(image_dir: Path) -> List[Tuple[str, int, int, int]]:
+    """
+    Read the name, number of planes, height and width of each TIFF in a directory.
+    """
+    shapes = []
+    for fp in sorted(image_dir.iterdir()):
+        if fp.suffix.lower() not in [".tif", ".tiff"]:
+            continue
+        with TiffFile(fp) as tif:
+            series = tif.series[0]
+            axes, shape = series.axes, series.shape
+        n_planes = shape[axes.index("Z")] if "Z" in axes else 1
+        shapes.append((fp.name, n_planes, shape[axes.index("Y")], shape[axes.index("X")]))
+    return shapes
+
+
+def profile(
+    cmd: List[str],
+    image_dir: Path,
+    bsize=224,
+    tile_overlap=0.1,
+    batch_size=8,
+    cpus=1
+) -> dict:
+    """
+    Run cellpose on the images in a directory, and summarize its throughput
+    and the peak resident memory of the process.
+
+    The number of tiles is estimated at the resolution of the input images,
+    with the tile size and overlap used by the cellpose CLI (224 px, 0.1),
+    while cellpose may rescale the images to the diameter of the model.
+    """
+
+    shapes = read_shapes(image_dir)
+
+    logger.info(f"Running {' '.join(cmd)}")
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True)
+    seconds = time.perf_counter() - start
+
+    n_pixels = sum(n_planes * height * width for _, n_planes, height, width in shapes)
+    n_tiles = sum(
+        n_planes * count_tiles(height, width, bsize=bsize, tile_overlap=tile_overlap)
+        for _, n_planes, height, width in shapes
+    )
+    return dict(
+        images=[name for name, _, _, _ in shapes],
+        cpus=cpus,
+        batch_size=batch_size,
+        bsize=bsize,
+        tile_overlap=tile_overlap,
+        n_pixels=n_pixels,
+        n_tiles=n_tiles,
+        seconds=round(seconds, 3),
+        tiles_per_second=round(n_tiles / seconds, 3) if seconds > 0 else None,
+        megapixels_per_second=round(n_pixels / 1e6 / seconds, 3) if seconds > 0 else None,
+        # Linux reports the peak resident set size of the child processes in KB
+        peak_rss_bytes=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    )
+
+
+def main(output_fp: Path, image_dir: Path, batch_size: int, cpus: int, cmd: List[str]):
+    stats = profile(cmd, image_dir, batch_size=batch_size, cpus=cpus)
+    logger.info(
+        f"Segmented {stats['n_tiles']:,} tiles in {stats['seconds']:,} seconds "
+        f"({stats['tiles_per_second']} tiles/s, peak RSS {stats['peak_rss_bytes'] / 2 ** 30:.2f} GB)"
+    )
+
+    logger.info(f"Writing {output_fp}")
+    with open(output_fp, "w") as handle:
+        json.dump(stats, handle, indent=4)
+
+
+if __name__ == '__main__':
+    # profile_cellpose.py <output.json> <image_dir> <batch_size> <cpus> cellpose ...
+    main(
+        Path(sys.argv[1]),
+        Path(sys.argv[2]),
+        int(sys.argv[3]),
+        int(sys.argv[4]),
+        sys.argv[5:]
+    )
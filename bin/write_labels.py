@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import json
+import logging
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from tifffile import imread, imwrite
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def write_labels(masks: np.ndarray, output_fp: Path, parameters: Dict[str, str], tile_size=512) -> dict:
+    """
+    Write an instance label image as a compressed, tiled TIFF,
+    along with a JSON file (with the same name) describing it.
+
+    Parameters
+    ----------
+    masks : np.ndarray
+        The label image, where the pixels of each cell hold its ID (0 = background).
+    output_fp : Path
+        The path of the TIFF, e.g. image_labels.tiff (and image_labels.json).
+    parameters : dict
+        The segmentation parameters, recorded in the JSON.
+
+    Returns
+    -------
+    metadata : dict
+        The contents of the JSON file.
+    """
+
+    # Use the smallest unsigned type which holds all of the cell IDs
+    max_label = int(masks.max()) if masks.size > 0 else 0
+    dtype = np.min_scalar_type(max_label) if max_label > 0 else np.dtype("uint8")
+    masks = masks.astype(dtype, copy=False)
+
+    logger.info(f"Writing {output_fp} ({masks.shape}, {dtype})")
+    imwrite(
+        output_fp,
+        masks,
+        photometric="minisblack",
+        tile=(tile_size, tile_size),
+        compression="zlib"
+    )
+
+    metadata = dict(
+        labels=output_fp.name,
+        shape=list(masks.shape),
+        dtype=str(dtype),
+        n_cells=int(np.count_nonzero(np.bincount(masks.ravel())[1:])) if max_label > 0 else 0,
+        max_label=max_label,
+        tile_size=tile_size,
+        compression="zlib",
+        parameters=parameters
+    )
+    with open(output_fp.with_suffix(".json"), "w") as handle:
+        json.dump(metadata, handle, indent=4)
+    return metadata
+
+
+def main(masks_fp: Path, output_fp: Path, parameters: List[str]):
+    logger.info(f"Reading {masks_fp}")
+    masks = imread(masks_fp)
+    metadata = write_labels(
+        masks,
+        output_fp,
+        dict(kv.split("=", 1) for kv in parameters)
+    )
+    logger.info(f"Wrote {metadata['n_cells']:,} cells to {output_fp}")
+
+
+if __name__ == '__main__':
+    # write_labels.py <image_cp_masks.tif> <image_labels.tiff> [key=value ...]
+    main(Path(sys.argv[1]), Path(sys.argv[2]), sys.argv[3:])
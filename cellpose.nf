@@ -4,6 +4,7 @@ nextflow.enable.dsl = 2
 
 include { cellpose } from './modules/cellpose.nf'
 include { dashboard } from './modules/dashboard.nf'
+include { read_samples } from './modules/shared.nf'
 
 workflow {
 
@@ -11,17 +12,27 @@ workflow {
     if("${params.output_folder}" == "false"){
         error "Parameter 'output_folder' must be specified"
     }
-    if("${params.input_tiff}" == "false"){
-        error "Parameter 'input_tiff' must be specified"
+    if("${params.input_tiff}" == "false" && "${params.sample_sheet}" == "false"){
+        error "Parameter 'input_tiff' (or 'sample_sheet') must be specified"
+    }
+    if(params.sample_sheet && params.update_dashboard){
+        error "Parameter 'update_dashboard' cannot be used with 'sample_sheet'"
     }
 
     log.info"""
 Inputs / Outputs:
     input_tiff:          ${params.input_tiff}
+    sample_sheet:        ${params.sample_sheet}
     output_folder:       ${params.output_folder}
+    max_memory:          ${params.max_memory}
+    tile_size:           ${params.tile_size}
+    tile_overlap:        ${params.tile_overlap}
+    tile_iou_threshold:  ${params.tile_iou_threshold}
 
 Cell Segmentation - Cellpose:
     pretrained_model:    ${params.pretrained_model}
+    model_cache:         ${params.model_cache}
+    pretrained_model_sha256: ${params.pretrained_model_sha256}
     channel_axis:        ${params.channel_axis}
     z_axis:              ${params.z_axis}
     segment_channel:     ${params.segment_channel}
@@ -31,6 +42,10 @@ Cell Segmentation - Cellpose:
     flow_threshold:      ${params.flow_threshold}
     cellprob_threshold:  ${params.cellprob_threshold}
     anisotropy:          ${params.anisotropy}
+    cellpose_cpus:       ${params.cellpose_cpus}
+    cellpose_batch_size: ${params.cellpose_batch_size}
+    cellpose_augment:    ${params.cellpose_augment}
+    cellpose_debug_outputs: ${params.cellpose_debug_outputs}
     exclude_on_edges:    ${params.exclude_on_edges}
     container:           ${params.container_cellpose}
 
@@ -43,17 +58,27 @@ Dashboard:
     cluster_method:      ${params.cluster_method}
     cluster_resolution:  ${params.cluster_resolution}
     cluster_n_neighbors: ${params.cluster_n_neighbors}
+    cluster_samples:     ${params.cluster_samples}
     scaling:             ${params.scaling}
+    scaling_chunksize:   ${params.scaling_chunksize}
     clip_lower:          ${params.clip_lower}
     clip_upper:          ${params.clip_upper}
+    zarr_compressor:     ${params.zarr_compressor}
+    zarr_compression_level: ${params.zarr_compression_level}
+    zarr_shuffle:        ${params.zarr_shuffle}
+    zarr_codec_benchmark: ${params.zarr_codec_benchmark}
+    zarr_chunk_size:     ${params.zarr_chunk_size}
+    zarr_chunk_bytes:    ${params.zarr_chunk_bytes}
+    spatialdata_cpus:    ${params.spatialdata_cpus}
+    polygon_tolerances:  ${params.polygon_tolerances}
+    image_cache_dir:     ${params.image_cache_dir}
+    checkpoint_dir:      ${params.checkpoint_dir}
+    update_dashboard:    ${params.update_dashboard}
     """
     }
 
-    // Set up the input file
-    input_tiff = file(
-        params.input_tiff,
-        checkIfExists: true
-    )
+    // Set up the input files, keyed by sample
+    input_tiff = read_samples()
 
     // Run cellpose
     cellpose(input_tiff)
@@ -69,7 +94,10 @@ Dashboard:
             cells.intensities,
             cells.cells_geo_json,
             input_tiff,
-            cells.pixel_size
+            cells.metadata,
+            cells.coordinate_units,
+            cells.calibration,
+            cells.preflight
         )
 
     }
@@ -1,49 +1,82 @@
-include { split_measurements } from './shared.nf'
+include { split_measurements; tiff_metadata; preflight; preflight as preflight_measurement } from './shared.nf'
 
 process find_cells {
     container "${params.container_cellpose}"
-    publishDir "${params.output_folder}/cellpose", mode: 'copy', overwrite: true
+    cpus params.cellpose_cpus
+    // Only the label image and the throughput of cellpose are published (the label image
+    // of each tile is stitched first), unless the debug outputs were requested
+    publishDir "${meta.outdir}/cellpose", mode: 'copy', overwrite: true, pattern: params.cellpose_debug_outputs ? "*" : (params.tile_size > 0 ? "*.cellpose_profile.json" : "{*_labels.*,*.cellpose_profile.json}")
 
     input:
-    path "inputs/"
+    tuple val(meta), path("inputs/")
     path "/tmp/cellpose_models/${params.pretrained_model}"
 
     output:
-    path "*.npy", emit: npy
-    path "*.tif", emit: tif
+    tuple val(meta), path("*_labels.tiff"), emit: labels
     path "*", emit: other
 
     script:
     template "cellpose.sh"
 }
 
-process measure_cells {
+process stage_model {
     container "${params.container_python}"
-    publishDir "${params.output_folder}/cellpose", mode: 'copy', overwrite: true
+
+    output:
+    path "${params.pretrained_model}"
+
+    script:
+    template "stage_model.py"
+}
+
+process split_tiles {
+    container "${params.container_python}"
+    publishDir "${meta.outdir}/cellpose", mode: 'copy', overwrite: true, pattern: "tiles.json"
 
     input:
-    path "input.tiff"
-    path npy
+    tuple val(meta), path(image)
 
     output:
-    path "cells.geojson.gz", emit: cells_geo_json
-    path "measurements.csv.gz", emit: measurements_csv
+    tuple val(meta), path("tiles/*.tiff"), emit: tiles
+    tuple val(meta), path("tiles.json"), emit: layout
 
     script:
-    template "parse_cellpose.py"
+    template "split_tiles.py"
 }
 
-process mock_pixel_size {
+process stitch_tiles {
     container "${params.container_python}"
-    publishDir "${params.output_folder}/cellpose", mode: 'copy', overwrite: true
+    publishDir "${meta.outdir}/cellpose", mode: 'copy', overwrite: true
+
+    input:
+    tuple val(meta), path(layout), path("*")
 
     output:
-    path "pixelWidth"
+    tuple val(meta), path("stitched_labels.tiff"), emit: labels
+    path "stitched_labels.json"
 
     script:
-    """#!/bin/bash
-echo "1.0" > pixelWidth
-    """
+    template "stitch_tiles.py"
+}
+
+process measure_cells {
+    container "${params.container_python}"
+    publishDir "${meta.outdir}/cellpose", mode: 'copy', overwrite: true
+    // Request the memory estimated from the header of the image (when max_memory is set),
+    // and all of max_memory if the task runs out of memory and is retried
+    memory { params.max_memory ? (task.attempt == 1 ? "${preflight.memory} B" : params.max_memory) : null }
+    errorStrategy { params.max_memory && task.exitStatus in 137..140 ? 'retry' : 'terminate' }
+    maxRetries 1
+
+    input:
+    tuple val(meta), path("input.tiff"), path(labels), val(preflight)
+
+    output:
+    tuple val(meta), path("cells.geojson.gz"), emit: cells_geo_json
+    tuple val(meta), path("measurements.csv.gz"), emit: measurements_csv
+
+    script:
+    template "parse_cellpose.py"
 }
 
 workflow cellpose {
@@ -52,28 +85,68 @@ workflow cellpose {
 
     main:
 
-    // Get the model
-    model_zip = file(
-        "https://www.cellpose.org/models/${params.pretrained_model}",
-        checkIfExists: true
+    // Get the model (downloaded once and staged for every sample)
+    if (params.model_cache) {
+        // Resolve the model from the local cache, only downloading it if missing
+        stage_model()
+        model_zip = stage_model.out.first()
+    } else {
+        model_zip = file(
+            "https://www.cellpose.org/models/${params.pretrained_model}",
+            checkIfExists: true
+        )
+    }
+
+    if (params.tile_size > 0) {
+        // Split the image into overlapping tiles and run cellpose
+        // on each tile in parallel, then stitch the masks back together
+        split_tiles(input_tiff)
+        tiles = split_tiles.out.tiles.map { meta, tiles -> [meta, tiles instanceof List ? tiles : [tiles]] }
+        find_cells(tiles.transpose(), model_zip)
+
+        // Stitch the tiles of each image as soon as all of them are segmented
+        tile_labels = find_cells.out.labels
+            .combine(tiles.map { meta, tiles -> [meta, tiles.size()] }, by: 0)
+            .map { meta, labels, n_tiles -> [groupKey(meta, n_tiles), labels] }
+            .groupTuple()
+            .map { key, labels -> [key.getGroupTarget(), labels] }
+        stitch_tiles(split_tiles.out.layout.join(tile_labels))
+        labels = stitch_tiles.out.labels
+    } else {
+        // Run cellpose to find cells
+        find_cells(input_tiff, model_zip)
+        labels = find_cells.out.labels
+    }
+
+    // Read the channel names and pixel size of the image
+    tiff_metadata(input_tiff)
+
+    // Estimate the memory needed to measure the cells from the header of the image
+    preflight_measurement(tiff_metadata.out.map { meta, metadata -> [meta, metadata, []] })
+    measurement_hints = preflight_measurement.out.map { meta, fp -> [meta, new groovy.json.JsonSlurper().parseText(fp.text)] }
+
+    // Parse the cell shapes from the label image
+    measure_cells(
+        input_tiff.join(labels).join(measurement_hints.map { meta, hint -> [meta, hint.stages.measurement] })
     )
 
-    // Run cellpose to find cells
-    find_cells(input_tiff, model_zip)
-
-    // Parse the cell shapes from .npy format
-    measure_cells(input_tiff, find_cells.out.npy)
+    // Estimate the memory needed by each of the following steps
+    preflight(tiff_metadata.out.join(measure_cells.out.measurements_csv))
+    hints = preflight.out.map { meta, fp -> [meta, new groovy.json.JsonSlurper().parseText(fp.text)] }
 
     // Parse out the spatial and attribute information
-    split_measurements(measure_cells.out.measurements_csv)
-
-    // Mock the pixel size
-    mock_pixel_size()
+    split_measurements(
+        measure_cells.out.measurements_csv.join(hints.map { meta, hint -> [meta, hint.stages.split] })
+    )
 
     emit:
     cells_geo_json = measure_cells.out.cells_geo_json
     spatial = split_measurements.out.spatial
     attributes = split_measurements.out.attributes
     intensities = split_measurements.out.intensities
-    pixel_size = mock_pixel_size.out
+    metadata = tiff_metadata.out
+    preflight = hints
+    // The cell coordinates from cellpose are in pixels, so there is no calibration
+    coordinate_units = Channel.value("pixel")
+    calibration = input_tiff.map { meta, image -> [meta, []] }
 }
\ No newline at end of file
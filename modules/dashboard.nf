@@ -1,31 +1,47 @@
 process leiden {
     container "${params.container_python}"
-    publishDir "${params.output_folder}/cell_clustering", mode: 'copy', overwrite: true
+    publishDir "${meta.outdir}/cell_clustering", mode: 'copy', overwrite: true
+    memory { params.max_memory ? (task.attempt == 1 ? "${preflight.memory} B" : params.max_memory) : null }
+    errorStrategy { params.max_memory && task.exitStatus in 137..140 ? 'retry' : 'terminate' }
+    maxRetries 1
 
     input:
-    path "*"
+    tuple val(meta), path("*"), val(preflight)
 
     output:
-    path "leiden_clusters.csv", emit: clusters
-    path "scaled_intensities.csv", emit: scaled_intensities
+    tuple val(meta), path("leiden_clusters.csv"), emit: clusters
+    tuple val(meta), path("scaled_intensities.csv"), emit: scaled_intensities
     path "figures/*.p*", emit: plots
 
     script:
+    // Scale the features chunk by chunk if the preflight check picked it,
+    // or if robust scaling ran out of memory
+    scaling = task.attempt > 1 && preflight.scaling == "robust" ? "robust_sketch" : preflight.scaling
     template "leiden.py"
 
 }
 
+process combine_features {
+    container "${params.container_python}"
+
+    input:
+    tuple val(samples), path(features, stageAs: "sample?/*")
+
+    output:
+    path "${params.cluster_by}.csv"
+
+    script:
+    template "combine_features.py"
+}
+
 process anndata {
     container "${params.container_python}"
 
     input:
-    path spatial
-    path attributes
-    path clusters
-    path intensities
+    tuple val(meta), path(spatial), path(attributes), path(clusters), path(intensities)
 
     output:
-    path "spatialdata.h5ad"
+    tuple val(meta), path("spatialdata.h5ad")
 
     script:
     template "make_anndata.py"
@@ -34,29 +50,64 @@ process anndata {
 
 process spatialdata {
     container "${params.container_python}"
-    publishDir "${params.output_folder}/dashboard", mode: 'copy', overwrite: true, pattern: "*.zarr.zip"
+    cpus params.spatialdata_cpus
+    publishDir "${meta.outdir}/dashboard", mode: 'copy', overwrite: true, pattern: "{*.zarr.zip,codec_benchmark.csv}"
+    memory { params.max_memory ? (task.attempt == 1 ? "${preflight.memory} B" : params.max_memory) : null }
+    errorStrategy { params.max_memory && task.exitStatus in 137..140 ? 'retry' : 'terminate' }
+    maxRetries 1
 
     input:
-    path anndata
-    path cells_geo_json
-    path image
-    path pixel_size
+    tuple val(meta), path(anndata), path(cells_geo_json), path(image), path(metadata), path(calibration), val(preflight)
+    val coordinate_units
 
     output:
-    path "spatialdata.zarr.zip", emit: zarr_zip
-    path "spatialdata.kwargs.json", emit: kwargs
+    tuple val(meta), path("spatialdata.zarr.zip"), emit: zarr_zip
+    tuple val(meta), path("spatialdata.kwargs.json"), emit: kwargs
+    path "codec_benchmark.csv", optional: true
 
     script:
     template "spatialdata.py"
 }
 
 
+process combine_anndata {
+    container "${params.container_python}"
+    publishDir "${params.output_folder}/combined", mode: 'copy', overwrite: true
+
+    input:
+    tuple val(samples), path(anndata, stageAs: "sample?/spatialdata.h5ad")
+
+    output:
+    path "combined.h5ad"
+
+    script:
+    template "combine_anndata.py"
+}
+
+
+process update_table {
+    container "${params.container_python}"
+    publishDir "${meta.outdir}/dashboard", mode: 'copy', overwrite: true, pattern: "*.zarr.zip"
+
+    input:
+    tuple val(meta), path(anndata)
+    path zarr_zip, stageAs: "existing/spatialdata.zarr.zip"
+
+    output:
+    tuple val(meta), path("spatialdata.zarr.zip"), emit: zarr_zip
+    tuple val(meta), path("spatialdata.kwargs.json"), emit: kwargs
+
+    script:
+    template "update_table.py"
+}
+
+
 process configure_vitessce {
     container "${params.container_python}"
-    publishDir "${params.output_folder}/dashboard", mode: 'copy', overwrite: true
+    publishDir "${meta.outdir}/dashboard", mode: 'copy', overwrite: true
 
     input:
-    path "spatialdata.kwargs.json"
+    tuple val(meta), path("spatialdata.kwargs.json")
 
     output:
     path "*.vt.json"
@@ -74,31 +125,93 @@ workflow dashboard {
     intensities
     cells_geo_json
     image
-    pixel_size
+    metadata
+    coordinate_units
+    calibration
+    preflight
 
     main:
 
-    // Cluster the cells
-    leiden(intensities)
+    if (params.sample_sheet && params.cluster_samples) {
+        // Cluster the cells of all samples together, on a shared neighbor graph
+        combine_features(
+            intensities
+                .map { meta, files -> [meta, [files].flatten().find { it.name == "${params.cluster_by}.csv" }] }
+                .toSortedList { a, b -> a[0].id <=> b[0].id }
+                .map { rows -> [rows.collect { it[0].id }, rows.collect { it[1] }] }
+        )
+
+        // The features of all samples are scaled and clustered in a single task
+        pooled_preflight = preflight
+            .map { meta, hint -> hint }
+            .toList()
+            .map { hints ->
+                def memory = hints.sum { it.stages.leiden.memory }
+                def budget = hints[0].memory_budget
+                def streaming = hints.any { it.stages.leiden.scaling == "robust_sketch" } || (
+                    params.scaling == "robust" && budget && memory > budget
+                )
+                [
+                    scaling: streaming ? "robust_sketch" : params.scaling,
+                    memory: budget ? Math.min(memory, budget) : memory
+                ]
+            }
+        leiden(
+            combine_features.out
+                .map { fp -> [[id: "combined", outdir: "${params.output_folder}/combined".toString()], fp] }
+                .combine(pooled_preflight)
+        )
+
+        // Each sample takes its own cells from the shared clusters
+        cells = spatial
+            .join(attributes)
+            .combine(leiden.out.clusters.map { meta, fp -> fp })
+            .combine(leiden.out.scaled_intensities.map { meta, fp -> fp })
+    } else {
+        // Cluster the cells of each sample
+        leiden(intensities.join(preflight.map { meta, hint -> [meta, hint.stages.leiden] }))
+
+        cells = spatial
+            .join(attributes)
+            .join(leiden.out.clusters)
+            .join(leiden.out.scaled_intensities)
+    }
 
     // Create anndata object
-    anndata(
-        spatial,
-        attributes,
-        leiden.out.clusters,
-        leiden.out.scaled_intensities
-    )
-
-    // Create spatial data object
-    spatialdata(
-        anndata.out,
-        cells_geo_json,
-        image,
-        pixel_size
-    )
+    anndata(cells)
+
+    if (params.sample_sheet) {
+        // Combine the cells of all samples, with the sample of each cell in obs
+        combine_anndata(
+            anndata.out
+                .toSortedList { a, b -> a[0].id <=> b[0].id }
+                .map { rows -> [rows.collect { it[0].id }, rows.collect { it[1] }] }
+        )
+    }
+
+    if (params.update_dashboard) {
+        // Only replace the table of an existing spatial data object
+        update_table(
+            anndata.out,
+            file(params.update_dashboard, checkIfExists: true)
+        )
+        kwargs = update_table.out.kwargs
+    } else {
+        // Create spatial data object
+        spatialdata(
+            anndata.out
+                .join(cells_geo_json)
+                .join(image)
+                .join(metadata)
+                .join(calibration)
+                .join(preflight.map { meta, hint -> [meta, hint.stages.spatialdata] }),
+            coordinate_units
+        )
+        kwargs = spatialdata.out.kwargs
+    }
 
     // Configure the displays using Vitessce 
     configure_vitessce(
-        spatialdata.out.kwargs
+        kwargs
     )
 }
\ No newline at end of file
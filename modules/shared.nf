@@ -1,15 +1,91 @@
+// Each image is processed along with a map of its sample ID
+// and the folder where its outputs are written (meta)
+def read_samples() {
+    if (!params.sample_sheet) {
+        def input_tiff = file(params.input_tiff, checkIfExists: true)
+        return Channel.of([[id: input_tiff.baseName, outdir: "${params.output_folder}".toString()], input_tiff])
+    }
+
+    // The sample sheet is a CSV with the columns "sample" and "input_tiff"
+    def rows = file(params.sample_sheet, checkIfExists: true).splitCsv(header: true)
+    if (rows.size() == 0) {
+        error "No samples were found in ${params.sample_sheet}"
+    }
+    rows.each { row ->
+        if (!row.sample || !row.input_tiff) {
+            error "Each row of the sample sheet must have a 'sample' and an 'input_tiff' (${row})"
+        }
+        // The ID names the output folder of the sample, and prefixes its cells when clustered together
+        if (!(row.sample ==~ /[A-Za-z0-9_.-]+/) || row.sample == "combined") {
+            error "Sample IDs may only contain letters, numbers, '_', '.' and '-', and 'combined' is reserved (${row.sample})"
+        }
+    }
+    def duplicated = rows.countBy { it.sample }.findAll { it.value > 1 }.keySet()
+    if (duplicated) {
+        error "Sample IDs must be unique (${duplicated.join(', ')})"
+    }
+
+    return Channel.fromList(
+        rows.collect { row ->
+            [
+                [id: row.sample, outdir: "${params.output_folder}/${row.sample}".toString()],
+                file(row.input_tiff, checkIfExists: true)
+            ]
+        }
+    )
+}
+
+
 process split_measurements {
     container "${params.container_python}"
-    publishDir "${params.output_folder}/cell_measurements", mode: 'copy', overwrite: true
+    publishDir "${meta.outdir}/cell_measurements", mode: 'copy', overwrite: true
+    // Request the memory estimated by the preflight check (when max_memory is set),
+    // and all of max_memory if the task runs out of memory and is retried
+    memory { params.max_memory ? (task.attempt == 1 ? "${preflight.memory} B" : params.max_memory) : null }
+    errorStrategy { params.max_memory && task.exitStatus in 137..140 ? 'retry' : 'terminate' }
+    maxRetries 1
 
     input:
-        path measurements_csv
+        tuple val(meta), path(measurements_csv), val(preflight)
 
     output:
-        path "spatial.csv", emit: spatial
-        path "attributes.csv", emit: attributes
-        path "*.*.csv", emit: intensities
+        tuple val(meta), path("spatial.csv"), emit: spatial
+        tuple val(meta), path("attributes.csv"), emit: attributes
+        tuple val(meta), path("*.*.csv"), emit: intensities
 
     script:
     template "split_measurements.sh"
 }
+
+
+process tiff_metadata {
+    container "${params.container_python}"
+    publishDir "${meta.outdir}", mode: 'copy', overwrite: true
+
+    input:
+        tuple val(meta), path(image)
+
+    output:
+        tuple val(meta), path("tiff_metadata.json")
+
+    script:
+    template "tiff_metadata.py"
+}
+
+
+process preflight {
+    container "${params.container_python}"
+    publishDir "${meta.outdir}", mode: 'copy', overwrite: true
+    // The estimates are compared with the memory available to each task
+    memory { params.max_memory ?: null }
+
+    input:
+        // Without a measurement table ([]), only the measurement step is estimated
+        tuple val(meta), path(metadata), path(measurements_csv)
+
+    output:
+        tuple val(meta), path("preflight*.json")
+
+    script:
+    template "preflight.py"
+}
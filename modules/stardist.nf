@@ -1,19 +1,19 @@
-include { split_measurements } from './shared.nf'
+include { split_measurements; tiff_metadata; preflight } from './shared.nf'
 
 process find_cells {
     container "${params.container_stardist}"
-    publishDir "${params.output_folder}/stardist", mode: 'copy', overwrite: true
+    publishDir "${meta.outdir}/stardist${tile.bounds ? '/tiles/' + tile.name : ''}", mode: 'copy', overwrite: true
 
     input:
         path script
         path seg_model
-        path "input.tiff"
+        tuple val(meta), path("input.tiff"), val(tile)
         path stardist_jar
 
     output:
-        path "measurements.csv.gz", emit: measurements_csv
-        path "cells.geo.json.gz", emit: cells_geo_json
-        path "qupath_project/project.qpproj", emit: project
+        tuple val(meta), path("*measurements.csv.gz"), path("*cells.geo.json.gz"), emit: cells
+        tuple val(meta), path("qupath_project/project.qpproj"), emit: project
+        tuple val(meta), path("*pixel_calibration.json"), emit: calibration
         path "*"
 
     script:
@@ -21,19 +21,37 @@ process find_cells {
 }
 
 
-process get_pixel_size {
+process plan_tiles {
     container "${params.container_python}"
+    publishDir "${meta.outdir}/stardist", mode: 'copy', overwrite: true
 
     input:
-        path qupath_project
+        tuple val(meta), path(metadata)
 
     output:
-        path "pixelWidth"
+        tuple val(meta), path("tiles.json")
 
     script:
-    template "get_pixel_size.py"
+    template "plan_tiles.py"
 }
 
+
+process merge_tiles {
+    container "${params.container_python}"
+    publishDir "${meta.outdir}/stardist", mode: 'copy', overwrite: true
+
+    input:
+        tuple val(meta), path(layout), path("*"), path("*")
+
+    output:
+        tuple val(meta), path("measurements.csv.gz"), emit: measurements_csv
+        tuple val(meta), path("cells.geo.json.gz"), emit: cells_geo_json
+
+    script:
+    template "merge_tiles.py"
+}
+
+
 workflow stardist {
     take:
     input_tiff
@@ -56,18 +74,50 @@ workflow stardist {
         checkIfExists: true
     )
 
-    find_cells(script, seg_model, input_tiff, stardist_jar)
+    // Read the channel names and pixel size of the image
+    tiff_metadata(input_tiff)
+
+    if (params.tile_size > 0) {
+        // Partition the image into tiles with a halo, detect the cells
+        // in each tile in parallel, then merge the cells of all tiles
+        plan_tiles(tiff_metadata.out)
+        tiles = plan_tiles.out.map { meta, layout -> [meta, new groovy.json.JsonSlurper().parseText(layout.text).tiles] }
+        find_cells(script, seg_model, input_tiff.combine(tiles.transpose(), by: 0), stardist_jar)
+
+        // Merge the tiles of each image as soon as all of them are segmented
+        tile_cells = find_cells.out.cells
+            .combine(tiles.map { meta, tiles -> [meta, tiles.size()] }, by: 0)
+            .map { meta, csv, geo_json, n_tiles -> [groupKey(meta, n_tiles), csv, geo_json] }
+            .groupTuple()
+            .map { key, csv, geo_json -> [key.getGroupTarget(), csv, geo_json] }
+        merge_tiles(plan_tiles.out.join(tile_cells))
+        measurements_csv = merge_tiles.out.measurements_csv
+        geo_json = merge_tiles.out.cells_geo_json
+    } else {
+        find_cells(script, seg_model, input_tiff.map { meta, image -> [meta, image, [name: "full", bounds: []]] }, stardist_jar)
+        measurements_csv = find_cells.out.cells.map { meta, csv, geo_json -> [meta, csv] }
+        geo_json = find_cells.out.cells.map { meta, csv, geo_json -> [meta, geo_json] }
+    }
 
-    split_measurements(find_cells.out.measurements_csv)
+    // Estimate the memory needed by each of the following steps
+    preflight(tiff_metadata.out.join(measurements_csv))
+    hints = preflight.out.map { meta, fp -> [meta, new groovy.json.JsonSlurper().parseText(fp.text)] }
 
-    get_pixel_size(find_cells.out.project)
+    split_measurements(
+        measurements_csv.join(hints.map { meta, hint -> [meta, hint.stages.split] })
+    )
 
     emit:
     project = find_cells.out.project
-    cells_geo_json = find_cells.out.cells_geo_json
+    cells_geo_json = geo_json
     spatial = split_measurements.out.spatial
     attributes = split_measurements.out.attributes
     intensities = split_measurements.out.intensities
-    pixel_size = get_pixel_size.out
+    metadata = tiff_metadata.out
+    preflight = hints
+    // The cell coordinates from QuPath are in microns, using the calibration
+    // which QuPath read from the image (the same for every tile)
+    coordinate_units = Channel.value("micron")
+    calibration = find_cells.out.calibration.unique { meta, fp -> meta }
 
 }
\ No newline at end of file
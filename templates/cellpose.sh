@@ -59,6 +59,32 @@ else
     chan2=""
 fi
 
+if [[ "${params.cellpose_augment}" == "true" ]]; then
+    echo "Test-time augmentation: enabled"
+    augment="--augment"
+else
+    echo "Test-time augmentation: disabled"
+    augment=""
+fi
+
+echo "Batch size: ${params.cellpose_batch_size}"
+
+# Only the masks are saved, unless the debug outputs were requested
+# (the _seg.npy with the flows, the outlines and the PNG overlays)
+if [[ "${params.cellpose_debug_outputs}" == "true" ]]; then
+    echo "Debug outputs: enabled"
+    debug_outputs="--save_outlines --save_png"
+else
+    echo "Debug outputs: disabled"
+    debug_outputs="--no_npy"
+fi
+
+# Use one torch and BLAS thread for each CPU of the task
+echo "Threads: ${task.cpus}"
+export OMP_NUM_THREADS=${task.cpus}
+export MKL_NUM_THREADS=${task.cpus}
+export OPENBLAS_NUM_THREADS=${task.cpus}
+
 if [[ "${params.anisotropy}" != "false" ]]; then
     echo "Anisotropy: ${params.anisotropy}"
     anisotropy="--anisotropy ${params.anisotropy}"
@@ -67,21 +93,30 @@ else
     anisotropy=""
 fi
 
+# Record the throughput and peak memory of cellpose
+image=\$(ls inputs | head -n 1)
+
 echo "\$(date) - Running cellpose"
-cellpose \
+profile_cellpose.py \
+    "\${image%.*}.cellpose_profile.json" \
+    inputs/ \
+    "${params.cellpose_batch_size}" \
+    "${task.cpus}" \
+    cellpose \
     --pretrained_model "${params.pretrained_model}" \
     --channel_axis "${params.channel_axis}" \
     --chan "${params.segment_channel}" \
     --diameter "${params.diameter}" \
     --flow_threshold "${params.flow_threshold}" \
     --cellprob_threshold "${params.cellprob_threshold}" \
+    --batch_size "${params.cellpose_batch_size}" \
+    \$augment \
     \$anisotropy \
     \$chan2 \
     \$z_axis \
     \$exclude_on_edges \
     \$no_resample \
-    --save_outlines \
-    --save_png \
+    \$debug_outputs \
     --save_tif \
     --dir inputs/ \
     --savedir . \
@@ -90,5 +125,21 @@ echo "\$(date) Done running cellpose"
 
 ls -lahtr *
 
-# Move the cell outlines into the same directory as everything else
-mv inputs/*npy ./
+# Write the masks as a compressed, tiled label image with its metadata
+echo "\$(date) - Writing the label image"
+write_labels.py \
+    "\${image%.*}_cp_masks.tif" \
+    "\${image%.*}_labels.tiff" \
+    pretrained_model="${params.pretrained_model}" \
+    diameter="${params.diameter}" \
+    flow_threshold="${params.flow_threshold}" \
+    cellprob_threshold="${params.cellprob_threshold}" \
+    segment_channel="${params.segment_channel}" \
+    nuclear_channel="${params.nuclear_channel}"
+
+if [[ "${params.cellpose_debug_outputs}" == "true" ]]; then
+    # Move the _seg.npy files into the same directory as everything else
+    mv inputs/*npy ./
+else
+    rm "\${image%.*}_cp_masks.tif"
+fi
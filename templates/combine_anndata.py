@@ -0,0 +1,41 @@
+#!/usr/local/bin/python3
+
+import anndata as ad
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def main(
+    samples="${samples.join(',')}",
+    pooled="${params.cluster_samples}",
+    output_fp="combined.h5ad"
+):
+    """
+    Combine the AnnData objects of all samples into a single object,
+    with the sample of each cell in obs and each cell indexed as sample/cell.
+    """
+
+    samples = samples.split(",")
+    adatas = []
+    for ix, sample in enumerate(samples, 1):
+        fp = f"sample{ix}/spatialdata.h5ad"
+        logger.info(f"Reading {sample} from {fp}")
+        adata = ad.read_h5ad(fp)
+        adata.obs_names = sample + "/" + adata.obs_names.astype(str)
+        adata.obs_names.name = None
+        adatas.append(adata)
+
+    # Features which were not measured in a sample are filled with NaN
+    adata = ad.concat(adatas, join="outer")
+    adata.obs["sample"] = adata.obs["sample"].astype("category")
+    if pooled != "true":
+        logger.info("The samples were clustered separately, so the leiden clusters of different samples do not correspond")
+
+    logger.info(f"Writing {adata.n_obs:,} cells and {adata.n_vars:,} features to {output_fp}")
+    adata.write(output_fp)
+
+
+main()
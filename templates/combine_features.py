@@ -0,0 +1,48 @@
+#!/usr/local/bin/python3
+
+import logging
+import pandas as pd
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def main(
+    samples="${samples.join(',')}",
+    features_fp="${params.cluster_by}.csv",
+    chunksize="${params.scaling_chunksize}"
+):
+    """
+    Concatenate the features of all samples into a single table, so that
+    the cells of every sample are scaled and clustered together.
+    Each cell is indexed as sample/cell, and the features are limited
+    to those measured in every sample.
+    """
+
+    samples = samples.split(",")
+    inputs = [f"sample{ix}/{features_fp}" for ix in range(1, len(samples) + 1)]
+
+    # Keep the features measured in all samples, in the order of the first
+    headers = [pd.read_csv(fp, index_col=0, nrows=0).columns for fp in inputs]
+    columns = [cname for cname in headers[0] if all(cname in header for header in headers[1:])]
+    for sample, header in zip(samples, headers):
+        dropped = header.difference(columns)
+        if len(dropped) > 0:
+            logger.warning(f"{sample}: dropping {len(dropped):,} features not measured in all samples")
+    assert len(columns) > 0, "No features were measured in all samples"
+
+    # Copy the tables chunk by chunk, without holding them in memory
+    n_rows = 0
+    for sample, fp in zip(samples, inputs):
+        logger.info(f"Reading {sample} from {fp}")
+        for chunk in pd.read_csv(fp, index_col=0, chunksize=int(chunksize)):
+            chunk = chunk[columns]
+            chunk.index = sample + "/" + chunk.index.astype(str)
+            chunk.to_csv(features_fp, mode="w" if n_rows == 0 else "a", header=n_rows == 0)
+            n_rows += chunk.shape[0]
+
+    logger.info(f"Wrote {n_rows:,} cells from {len(samples):,} samples to {features_fp}")
+
+
+main()
@@ -19,28 +19,47 @@ def format_vitessce_segmentation(
     zarr_fp: str,
     image_key: str,
     channel_names: list,
-    mask_channels: list,
+    labels_key: str,
+    channel_windows: List[List[float]] = None,
+    segmentations_key: str = None,
     schema_version = "1.0.16",
     obs_type = "cell",
     **kwargs
 ):
     name = "StarDist Segmentation"
     description = "Image display with cell outlines from StarDist"
-    
+
+    # The cell outlines are shown from the label image (e.g. labels/cell_labels)
+    if labels_key is None:
+        raise ValueError("A label image of either cells or nuclei is required")
+
+    # Show the simplified cell outlines (e.g. shapes/cell_boundaries_lod1)
+    # as polygons, if they were stored
+    if segmentations_key is not None:
+        return add_polygon_layer(
+            format_vitessce_segmentation(
+                zarr_fp,
+                image_key,
+                channel_names,
+                labels_key,
+                channel_windows=channel_windows,
+                schema_version=schema_version,
+                obs_type=obs_type
+            ),
+            zarr_fp,
+            segmentations_key,
+            obs_type=obs_type
+        )
+
     # Set up the channels that will be displayed.
-    # Note that this includes the channels which are shown across both spatial plots.
     # Since there are only three colors which can be shown easily, we will only include slots for three channels.
-    # That is in addition to the mask channel.
-    # The left-hand image will get A, B, C, D, and the right-hand image will get E, F, G, H.
-    if "cell" in mask_channels:
-        mask_ix = channel_names.index("cell")
-    elif "nucleus" in mask_channels:
-        mask_ix = channel_names.index("nucleus")
-    else:
-        raise ValueError("The mask channel must be either 'cell' or 'nucleus'")
+    image_ixs = list(range(len(channel_names)))
 
-    # Find the non-mask channels
-    image_ixs = [i for i, c in enumerate(channel_names) if c not in mask_channels]
+    # The contrast window of each channel (e.g. p1-p99), if it was computed
+    windows = [
+        channel_windows[ix] if channel_windows is not None else None
+        for ix in image_ixs
+    ]
 
     return {
         "version": schema_version,
@@ -61,6 +80,17 @@ def format_vitessce_segmentation(
                         "options": {
                             "path": f'images/{image_key}'
                         }
+                    },
+                    {
+                        "url": zarr_fp,
+                        "fileType": "labels.spatialdata.zarr",
+                        "coordinationValues": {
+                            "fileUid": labels_key,
+                            "obsType": obs_type
+                        },
+                        "options": {
+                            "path": f'labels/{labels_key}'
+                        }
                     }
                 ]
             }
@@ -69,6 +99,9 @@ def format_vitessce_segmentation(
             "dataset": {
                 "A": "A"
             },
+            "obsType": {
+                "A": obs_type
+            },
             "spatialTargetZ": {
                 "A": 0
             },
@@ -78,14 +111,20 @@ def format_vitessce_segmentation(
             "imageLayer": {
                 "A": "__dummy__"
             },
+            "segmentationLayer": {
+                "A": "__dummy__"
+            },
             "fileUid": {
-                "A": "image"
+                "A": image_key,
+                "B": labels_key
             },
             "spatialLayerOpacity": {
-                "A": 1
+                "A": 1,
+                "B": 1
             },
             "spatialLayerVisible": {
-                "A": True
+                "A": True,
+                "B": True
             },
             "photometricInterpretation": {
                 "A": "BlackIsZero"
@@ -95,36 +134,50 @@ def format_vitessce_segmentation(
                 "B": "__dummy__",
                 "C": "__dummy__"
             },
+            "segmentationChannel": {
+                "A": "__dummy__"
+            },
             "spatialTargetC": {
-                "A": mask_ix,
-                "B": image_ixs[0] if len(image_ixs) > 0 else None,
-                "C": image_ixs[1] if len(image_ixs) > 1 else None
+                "A": image_ixs[0] if len(image_ixs) > 0 else None,
+                "B": image_ixs[1] if len(image_ixs) > 1 else None,
+                "C": image_ixs[2] if len(image_ixs) > 2 else None,
+                "D": 0
             },
             "spatialChannelColor": {
                 "A": color_wheel[0],
                 "B": color_wheel[1],
-                "C": color_wheel[2]
+                "C": color_wheel[2],
+                "D": [255, 255, 255]
             },
             "spatialChannelWindow": {
-                "A": None,
-                "B": None,
-                "C": None
+                "A": windows[0] if len(windows) > 0 else None,
+                "B": windows[1] if len(windows) > 1 else None,
+                "C": windows[2] if len(windows) > 2 else None
             },
             "spatialChannelVisible": {
                 "A": True,
                 "B": True,
-                "C": True
+                "C": True,
+                "D": True
             },
             "spatialChannelOpacity": {
                 "A": 1,
                 "B": 1,
-                "C": 1
+                "C": 1,
+                "D": 1
+            },
+            "spatialSegmentationFilled": {
+                "A": False
+            },
+            "spatialSegmentationStrokeWidth": {
+                "A": 1
             },
             "metaCoordinationScopes": {
                 "A": {
                     "spatialTargetZ": "A",
                     "spatialTargetT": "A",
-                    "imageLayer": "A"
+                    "imageLayer": "A",
+                    "segmentationLayer": "A"
                 }
             },
             "metaCoordinationScopesBy": {
@@ -176,6 +229,45 @@ def format_vitessce_segmentation(
                             "B": "B",
                             "C": "C"
                         }
+                    },
+                    "segmentationLayer": {
+                        "fileUid": {
+                            "A": "B"
+                        },
+                        "spatialLayerOpacity": {
+                            "A": "B"
+                        },
+                        "spatialLayerVisible": {
+                            "A": "B"
+                        },
+                        "segmentationChannel": {
+                            "A": [
+                                "A"
+                            ]
+                        }
+                    },
+                    "segmentationChannel": {
+                        "obsType": {
+                            "A": "A"
+                        },
+                        "spatialTargetC": {
+                            "A": "D"
+                        },
+                        "spatialChannelColor": {
+                            "A": "D"
+                        },
+                        "spatialChannelVisible": {
+                            "A": "D"
+                        },
+                        "spatialChannelOpacity": {
+                            "A": "D"
+                        },
+                        "spatialSegmentationFilled": {
+                            "A": "A"
+                        },
+                        "spatialSegmentationStrokeWidth": {
+                            "A": "A"
+                        }
                     }
                 }
             }
@@ -218,12 +310,76 @@ def format_vitessce_segmentation(
     }
 
 
+def add_polygon_layer(
+    vt_config: dict,
+    zarr_fp: str,
+    segmentations_key: str,
+    obs_type = "cell"
+) -> dict:
+    """
+    Add the cell outlines as a layer of polygons (obsSegmentations) to the
+    segmentation view. The polygons replace the label image, which is
+    hidden by default, since they render smoothly when zoomed out.
+    """
+
+    vt_config["datasets"][0]["files"].append({
+        "url": zarr_fp,
+        "fileType": "obsSegmentations.spatialdata.zarr",
+        "coordinationValues": {
+            "fileUid": segmentations_key,
+            "obsType": obs_type
+        },
+        "options": {
+            "path": f"shapes/{segmentations_key}",
+            "tablePath": "tables/table"
+        }
+    })
+
+    space = vt_config["coordinationSpace"]
+    space["segmentationLayer"]["B"] = "__dummy__"
+    space["segmentationChannel"]["B"] = "__dummy__"
+    space["fileUid"]["C"] = segmentations_key
+    space["spatialLayerOpacity"]["C"] = 1
+    space["spatialLayerVisible"]["B"] = False
+    space["spatialLayerVisible"]["C"] = True
+    space["spatialTargetC"]["E"] = 0
+    space["spatialChannelColor"]["E"] = [255, 255, 255]
+    space["spatialChannelVisible"]["E"] = True
+    space["spatialChannelOpacity"]["E"] = 1
+    space["spatialSegmentationFilled"]["B"] = False
+    space["spatialSegmentationStrokeWidth"]["B"] = 1
+
+    space["metaCoordinationScopes"]["A"]["segmentationLayer"] = ["A", "B"]
+
+    scopes_by = space["metaCoordinationScopesBy"]["A"]
+    for kw, val in [
+        ("fileUid", "C"),
+        ("spatialLayerOpacity", "C"),
+        ("spatialLayerVisible", "C"),
+        ("segmentationChannel", ["B"])
+    ]:
+        scopes_by["segmentationLayer"][kw]["B"] = val
+    for kw, val in [
+        ("obsType", "A"),
+        ("spatialTargetC", "E"),
+        ("spatialChannelColor", "E"),
+        ("spatialChannelVisible", "E"),
+        ("spatialChannelOpacity", "E"),
+        ("spatialSegmentationFilled", "B"),
+        ("spatialSegmentationStrokeWidth", "B")
+    ]:
+        scopes_by["segmentationChannel"][kw]["B"] = val
+
+    return vt_config
+
+
 def format_vitessce_cell_measurements(
     zarr_fp: str,
     image_key: str,
     obs_set_paths: List[str],
     obs_set_names: List[str],
     init_gene: str,
+    channel_windows: List[List[float]] = None,
     schema_version = "1.0.16",
     obs_type = "cell",
     feature_type = "marker",
@@ -235,6 +391,9 @@ def format_vitessce_cell_measurements(
     name = "Cell Measurements"
     description = "Image display with average channel intensity for each cell"
 
+    # The contrast window of the first channel, if it was computed
+    window = channel_windows[0] if channel_windows else None
+
     return {
             "version": schema_version,
             "name": name,
@@ -366,8 +525,8 @@ def format_vitessce_cell_measurements(
                     "B": [255, 255, 255]
                 },
                 "spatialChannelWindow": {
-                    "A": None,
-                    "B": None
+                    "A": window,
+                    "B": window
                 },
                 "spatialChannelVisible": {
                     "A": True,
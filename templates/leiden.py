@@ -1,7 +1,9 @@
 #!/usr/local/bin/python3
 
 from anndata import AnnData
+from typing import List
 import scanpy as sc
+import numpy as np
 import os
 import pandas as pd
 import logging
@@ -18,6 +20,111 @@ def robust_scale(vals: pd.Series):
     return (vals - vals.median()) / (vals.quantile(0.75) - vals.quantile(0.25))
 
 
+class QuantileSketch:
+    """
+    Mergeable approximate quantile sketch for every column of a table.
+
+    Each column is summarized by at most `size` weighted centroids.
+    Whenever a chunk of rows (or another sketch) is merged in, the
+    centroids are sorted and re-binned into equal-weight bins, so the
+    rank error of any quantile is bounded by roughly 1 / size.
+    """
+
+    def __init__(self, n_cols: int, size=2000):
+        self.size = size
+        self.means = [np.empty(0) for _ in range(n_cols)]
+        self.weights = [np.empty(0) for _ in range(n_cols)]
+
+    def update(self, values: np.ndarray):
+        """Add a (rows x columns) chunk of values, ignoring NaNs."""
+        for ix in range(values.shape[1]):
+            col = values[:, ix]
+            col = col[~np.isnan(col)]
+            self._add(ix, col, np.ones(col.shape[0]))
+
+    def merge(self, other: "QuantileSketch"):
+        """Merge the centroids of another sketch into this one."""
+        for ix in range(len(self.means)):
+            self._add(ix, other.means[ix], other.weights[ix])
+
+    def _add(self, ix: int, means: np.ndarray, weights: np.ndarray):
+        means = np.concatenate([self.means[ix], means])
+        weights = np.concatenate([self.weights[ix], weights])
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+
+        # Collapse into equal-weight bins if there are too many centroids
+        if means.shape[0] > self.size:
+            rank = (np.cumsum(weights) - weights / 2) / weights.sum()
+            bins = np.minimum((rank * self.size).astype(int), self.size - 1)
+            bin_weights = np.bincount(bins, weights=weights, minlength=self.size)
+            bin_sums = np.bincount(bins, weights=weights * means, minlength=self.size)
+            keep = bin_weights > 0
+            means = bin_sums[keep] / bin_weights[keep]
+            weights = bin_weights[keep]
+
+        self.means[ix], self.weights[ix] = means, weights
+
+    def quantile(self, q: float) -> np.ndarray:
+        """Approximate quantile `q` (0-1) of every column."""
+        vals = []
+        for means, weights in zip(self.means, self.weights):
+            if means.shape[0] == 0:
+                vals.append(np.nan)
+                continue
+            rank = np.cumsum(weights) - weights / 2
+            vals.append(np.interp(q * weights.sum(), rank, means))
+        return np.array(vals)
+
+
+def stream_robust_scale(
+    fp: str,
+    output_fp: str,
+    clip_lower: float,
+    clip_upper: float,
+    chunksize: int
+) -> List[str]:
+    """
+    Robust scaling of a CSV table without holding it in memory.
+
+    The medians and IQRs of each column are estimated with a QuantileSketch
+    in a first pass over row chunks of the file. In a second pass, each chunk
+    is scaled, clipped and appended to `output_fp`.
+
+    Returns
+    -------
+    List[str]
+        The columns which did not contain any NaN values after scaling.
+    """
+
+    logger.info(f"Estimating column quantiles from {fp} (chunksize={chunksize:,})")
+    sketch = None
+    n_rows = 0
+    for chunk in pd.read_csv(fp, index_col=0, chunksize=chunksize):
+        chunk_sketch = QuantileSketch(chunk.shape[1])
+        chunk_sketch.update(chunk.values.astype(float))
+        if sketch is None:
+            sketch = chunk_sketch
+        else:
+            sketch.merge(chunk_sketch)
+        n_rows += chunk.shape[0]
+    assert sketch is not None, f"No rows found in {fp}"
+    logger.info(f"Summarized {n_rows:,} rows")
+
+    median = sketch.quantile(0.5)
+    iqr = sketch.quantile(0.75) - sketch.quantile(0.25)
+
+    logger.info(f"Writing scaled values to {output_fp}")
+    has_nan = None
+    for ix, chunk in enumerate(pd.read_csv(fp, index_col=0, chunksize=chunksize)):
+        chunk = ((chunk - median) / iqr).clip(lower=clip_lower, upper=clip_upper)
+        chunk_has_nan = chunk.isna().any().values
+        has_nan = chunk_has_nan if has_nan is None else (has_nan | chunk_has_nan)
+        chunk.to_csv(output_fp, mode="w" if ix == 0 else "a", header=ix == 0)
+
+    return [cname for cname, nan in zip(chunk.columns, has_nan) if not nan]
+
+
 def scale_intensities(
     df: pd.DataFrame,
     scaling: str,
@@ -33,6 +140,7 @@ def scale_intensities(
         The DataFrame containing the data to scale.
     scaling : str
         The scaling method to use. One of "robust", "zscore", "minmax", or "none".
+        The "robust_sketch" method is handled by stream_robust_scale instead.
     clip_lower : float
         The lower bound to clip the data to.
     clip_upper : float
@@ -140,18 +248,41 @@ def main():
     fp = "${params.cluster_by}.csv"
     if not os.path.exists(fp):
         raise FileNotFoundError(f"Could not find file: {fp}")
-    logger.info(f"Reading data from: {fp}")
-    df = pd.read_csv(fp, index_col=0)
 
     # Scale the data as needed
     logger.info("Scaling the data")
-    logger.info("scaling=${params.scaling}, clip_lower=${params.clip_lower}, clip_upper=${params.clip_upper}")
-    df = scale_intensities(
-        df,
-        scaling="${params.scaling}",
-        clip_lower=float("${params.clip_lower}"),
-        clip_upper=float("${params.clip_upper}")
-    )
+    logger.info("scaling=${scaling}, clip_lower=${params.clip_lower}, clip_upper=${params.clip_upper}")
+
+    if "${scaling}" == "robust_sketch":
+        # Scale chunk by chunk, and only read back the scaled
+        # columns which will be used for clustering
+        tmp_fp = "scaled_intensities.unfiltered.csv"
+        keep_cols = stream_robust_scale(
+            fp,
+            tmp_fp,
+            clip_lower=float("${params.clip_lower}"),
+            clip_upper=float("${params.clip_upper}"),
+            chunksize=int("${params.scaling_chunksize}")
+        )
+        logger.info(f"Reading scaled data from: {tmp_fp}")
+        index_col = pd.read_csv(tmp_fp, nrows=0).columns[0]
+        df = pd.read_csv(
+            tmp_fp,
+            index_col=0,
+            usecols=[index_col] + keep_cols,
+            dtype={cname: "float32" for cname in keep_cols}
+        )
+        os.remove(tmp_fp)
+
+    else:
+        logger.info(f"Reading data from: {fp}")
+        df = pd.read_csv(fp, index_col=0)
+        df = scale_intensities(
+            df,
+            scaling="${scaling}",
+            clip_lower=float("${params.clip_lower}"),
+            clip_upper=float("${params.clip_upper}")
+        )
 
     # Drop any columns which have NaN values
     logger.info("Dropping columns with NaN values")
@@ -35,18 +35,40 @@ def sanitize_cnames(cname: str) -> str:
     return cname
 
 
+def select_sample(df: pd.DataFrame, sample: str) -> pd.DataFrame:
+    """
+    Select the cells of one sample from a table of all samples
+    clustered together (indexed by sample/cell), restoring the cell index.
+    """
+    prefix = f"{sample}/"
+    df = df[df.index.str.startswith(prefix)]
+    df.index = df.index.str[len(prefix):]
+    logger.info(f"Selected {df.shape[0]:,} objects from sample {sample}")
+    return df
+
+
 def main(
     spatial = "${spatial}",
     attributes = "${attributes}",
     clusters = "${clusters}",
     intensities = "${intensities}",
-    instance_key = "${params.instance_key}"
+    instance_key = "${params.instance_key}",
+    sample = "${meta.id}",
+    batch = "${params.sample_sheet ? 'true' : 'false'}",
+    pooled = "${params.sample_sheet && params.cluster_samples ? 'true' : 'false'}"
 ):
     spatial = read_csv(spatial, "spatial data")
     attributes = read_csv(attributes, "attributes")
     clusters = read_csv(clusters, "clusters")
     intensities = read_csv(intensities, "intensities")
 
+    # The clusters and intensities are shared by all samples
+    if pooled == "true":
+        spatial.index = spatial.index.astype(str)
+        attributes.index = attributes.index.astype(str)
+        clusters = select_sample(clusters, sample)
+        intensities = select_sample(intensities, sample)
+
     # The index for all tables must be the same
     logger.info("Checking that all tables have the same index")
     assert spatial.index.equals(attributes.index)
@@ -61,6 +83,10 @@ def main(
     # Note that "Object ID" will be renamed to "object_id"
     obs = obs.rename(columns=sanitize_cnames)
 
+    # Record the sample of each cell when processing a sample sheet
+    if batch == "true":
+        obs["sample"] = sample
+
     # Make sure that the instance_key (i.e. "object_id") is one of the columns
     if not instance_key in obs.columns:
         raise ValueError(f"The column '{instance_key}' must be present in the attributes file")
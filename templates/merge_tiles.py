@@ -0,0 +1,137 @@
+#!/usr/local/bin/python3
+
+from shapely.geometry import shape
+from typing import List, Tuple
+import gzip
+import json
+import logging
+import numpy as np
+import pandas as pd
+import shapely
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def main(
+    layout="${layout}",
+    iou_threshold="${params.tile_iou_threshold}",
+    measurements_fp="measurements.csv.gz",
+    cells_fp="cells.geo.json.gz"
+):
+    """
+    Merge the cells detected by StarDist in each tile (with its halo)
+    into a single set of measurements and cell outlines, keeping one copy
+    of each cell which was detected in more than one tile.
+    """
+
+    with open(layout) as f:
+        layout = json.load(f)
+    iou_threshold = float(iou_threshold)
+
+    # Keep the cells whose centroid is in the core of their tile, extended by
+    # half of the overlap so that cells on the edge of a core are not missed
+    # when each tile finds a slightly different centroid
+    margin = layout["overlap"] / 2
+    features, tile_ix = [], []
+    for ix, tile in enumerate(layout["tiles"]):
+        owned = read_owned_cells(f"{tile['name']}.cells.geo.json.gz", tile, margin)
+        logger.info(f"{tile['name']}: {len(owned):,} cells")
+        features.extend(owned)
+        tile_ix.extend([ix] * len(owned))
+    tile_ix = np.array(tile_ix)
+
+    # Drop the copies of cells which were also kept from an earlier tile
+    # (i.e. in the margin between two cores)
+    polygons = np.array([shape(feature["geometry"]) for feature in features])
+    duplicated = find_duplicates(polygons, tile_ix, iou_threshold)
+    logger.info(f"Found {len(features):,} cells ({duplicated.sum():,} duplicates removed)")
+    features = [
+        feature
+        for feature, dup in zip(features, duplicated)
+        if not dup
+    ]
+
+    logger.info(f"Writing {cells_fp}")
+    with gzip.open(cells_fp, "wt") as f:
+        json.dump(features, f)
+
+    # Keep the measurements of the same cells, in the same order
+    kept_ids = pd.Index([str(feature["id"]) for feature in features])
+    measurements = pd.concat(
+        [
+            pd.read_csv(f"{tile['name']}.measurements.csv.gz")
+            for tile in layout["tiles"]
+        ],
+        ignore_index=True
+    )
+    measurements.index = measurements["Object ID"].astype(str)
+    measurements = measurements[~measurements.index.duplicated()]
+
+    missing = kept_ids.difference(measurements.index)
+    if len(missing) > 0:
+        raise ValueError(f"{len(missing):,} cells were not found in the measurements (e.g. {missing[0]})")
+
+    logger.info(f"Writing {measurements_fp}")
+    measurements.loc[kept_ids].to_csv(measurements_fp, index=False)
+
+
+def read_owned_cells(fp: str, tile: dict, margin: float) -> List[dict]:
+    """Read the cells of a tile whose centroid is within margin of the core of the tile."""
+
+    logger.info(f"Reading {fp}")
+    with gzip.open(fp, "rt") as f:
+        features = json.load(f)
+    if isinstance(features, dict):
+        features = features["features"]
+    if len(features) == 0:
+        return []
+
+    # The outlines are in pixel coordinates of the whole image
+    centroids = shapely.get_coordinates(
+        shapely.centroid([shape(feature["geometry"]) for feature in features])
+    )
+    y0, x0, y1, x1 = tile["core"]
+    owned = (
+        (centroids[:, 0] >= x0 - margin) & (centroids[:, 0] < x1 + margin) &
+        (centroids[:, 1] >= y0 - margin) & (centroids[:, 1] < y1 + margin)
+    )
+    return [
+        feature
+        for feature, keep in zip(features, owned)
+        if keep
+    ]
+
+
+def find_duplicates(
+    polygons: np.ndarray,
+    tile_ix: np.ndarray,
+    iou_threshold: float
+) -> np.ndarray:
+    """
+    Flag the cells which overlap a cell from an earlier tile with an IoU
+    of at least iou_threshold, or which are mostly covered by it
+    (i.e. the same cell detected in two tiles, as in stitch_tiles.py).
+    """
+
+    duplicated = np.zeros(len(polygons), dtype=bool)
+    if len(polygons) == 0:
+        return duplicated
+
+    tree = shapely.STRtree(polygons)
+    left, right = tree.query(polygons, predicate="intersects")
+
+    # Pairs of cells from different tiles, where the right one is from the later tile
+    pairs = tile_ix[left] < tile_ix[right]
+    left, right = left[pairs], right[pairs]
+
+    inter = shapely.area(shapely.intersection(polygons[left], polygons[right]))
+    right_area = shapely.area(polygons[right])
+    union = shapely.area(polygons[left]) + right_area - inter
+    iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+    duplicated[right[(iou >= iou_threshold) | (inter > right_area / 2)]] = True
+    return duplicated
+
+
+main()
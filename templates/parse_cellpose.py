@@ -6,6 +6,8 @@ from typing import List
 import numpy as np
 import pandas as pd
 from skimage import io
+from skimage.segmentation import find_boundaries
+from tifffile import imread
 import logging
 
 # Set up logging
@@ -15,17 +17,19 @@ logger = logging.getLogger()
 
 def main():
 
-    fp = "${npy}"
+    fp = "${labels}"
 
     logger.info(f"Loading {fp}")
-    data = np.load(fp, allow_pickle=True).item()
+    masks = imread(fp)
+    logger.info(f"Label image: {masks.shape} ({masks.dtype})")
 
-    for kw, val in data.items():
-        logger.info(f"{kw}: {val}")
+    # Outline the cells, labelling each boundary pixel with the ID of its cell
+    logger.info("Finding the cell outlines")
+    outlines = masks * find_boundaries(masks, mode="inner")
 
     # Convert the cells from the numpy array to GeoJSON format
     logger.info("Converting cells to GeoJSON")
-    geojson = make_geojson(data["outlines"])
+    geojson = make_geojson(outlines)
 
     # Save the GeoJSON to a gzip compressed JSON file
     logger.info("Saving GeoJSON")
@@ -38,12 +42,12 @@ def main():
 
     # Measure the intensity of each channel for each cell
     logger.info("Measuring intensity")
-    measurements = measure_intensity(img, data["masks"])
+    measurements = measure_intensity(img, masks)
 
     # Add the centroid coordinates to the measurements
     logger.info("Adding centroids")
     measurements = measurements.merge(
-        find_centroids(data["masks"]),
+        find_centroids(masks),
         on="Object ID",
         how="left"
     )
@@ -0,0 +1,73 @@
+#!/usr/local/bin/python3
+
+from typing import List
+import json
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def main(
+    metadata="${metadata}",
+    tile_size="${params.tile_size}",
+    overlap="${params.tile_overlap}",
+    layout_fp="tiles.json"
+):
+    """
+    Partition the image into tiles with a halo of overlap on each side,
+    using the shape from tiff_metadata.json, so that each tile can be
+    segmented as a separate task (in the same layout as split_tiles.py).
+    """
+
+    with open(metadata) as f:
+        metadata = json.load(f)
+
+    axes = metadata["axes"]
+    if "Y" not in axes or "X" not in axes:
+        raise ValueError(f"Expected an image with Y and X axes, found {axes}")
+    height = metadata["shape"][axes.index("Y")]
+    width = metadata["shape"][axes.index("X")]
+
+    tile_size = int(tile_size)
+    overlap = int(overlap)
+
+    tiles = [
+        dict(
+            name=f"tile_{y0:06d}_{x0:06d}",
+            core=[y0, x0, y1, x1],
+            bounds=[
+                max(y0 - overlap, 0),
+                max(x0 - overlap, 0),
+                min(y1 + overlap, height),
+                min(x1 + overlap, width)
+            ]
+        )
+        for y0, y1 in split_axis(height, tile_size)
+        for x0, x1 in split_axis(width, tile_size)
+    ]
+    logger.info(f"Partitioned the {height} x {width} image into {len(tiles):,} tiles")
+
+    with open(layout_fp, "w") as f:
+        json.dump(
+            dict(
+                shape=[height, width],
+                tile_size=tile_size,
+                overlap=overlap,
+                tiles=tiles
+            ),
+            f,
+            indent=4
+        )
+
+
+def split_axis(size: int, tile_size: int) -> List[List[int]]:
+    """Split an axis into intervals of tile_size (the last may be shorter)."""
+    return [
+        [start, min(start + tile_size, size)]
+        for start in range(0, size, tile_size)
+    ]
+
+
+main()
@@ -0,0 +1,241 @@
+#!/usr/local/bin/python3
+
+from typing import List, Tuple, Union
+import csv
+import json
+import logging
+import math
+import numpy as np
+import os
+import zlib
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+# Rough sizes used for the estimates, erring on the high side
+# The Python interpreter and libraries of each step: importing pandas and anndata
+# takes ~165 MB of resident memory, and spatialdata ~290 MB, so round up to 512 MB
+BYTES_PER_PROCESS = 512 << 20
+# Each value of a table read by pandas: 8 bytes as float64, and as much again
+# for the copy made when selecting or converting the columns
+BYTES_PER_VALUE = 16
+# Each pixel in parse_cellpose.py: the uint32 masks (4 bytes), find_boundaries
+# (peaks at ~9 bytes per pixel) and the outlines multiplied from both (8 bytes)
+BYTES_PER_MASK_PIXEL = 24
+# Each cell outline held as a shapely polygon by spatialdata.py:
+# ~1.3 KB for a polygon of 40 vertices, rounded up
+BYTES_PER_OUTLINE = 2048
+# Each edge of the neighbor graph: the distances, connectivities and UMAP graph
+# are each a sparse matrix of float64 values and int32 indices (3 x 12 bytes), plus the kNN search
+BYTES_PER_EDGE = 48
+# Copies of each chunk of the image held by a worker: the chunk read, its downsampled
+# levels, the encoded (compressed) buffer and the copies held by the dask tasks
+CHUNK_COPIES = 8
+# Margin added to each estimate when requesting memory,
+# since the estimates above leave out fragmentation and temporaries
+HEADROOM = 1.25
+
+
+def main(
+    metadata="${metadata}",
+    measurements_csv="${measurements_csv ?: ''}",
+    memory_budget="${task.memory ? task.memory.toBytes() : 0}",
+    output_fp="${measurements_csv ? 'preflight.json' : 'preflight.measurement.json'}"
+):
+    """
+    Estimate the peak memory of each stage of the pipeline from the header
+    of the TIFF and the size of the measurement table, and pick the mode
+    of each stage which fits in the memory available to each task.
+
+    Without a measurement table (before the cells are measured),
+    only the measurement stage is estimated, from the header of the TIFF.
+    """
+
+    with open(metadata) as f:
+        metadata = json.load(f)
+
+    memory_budget = int(memory_budget)
+    if memory_budget > 0:
+        logger.info(f"Memory available to each task: {format_bytes(memory_budget)}")
+    else:
+        logger.info("No memory limit was set (max_memory), only reporting the estimates")
+
+    if measurements_csv == "":
+        table, stages = dict(), dict(
+            measurement=dict(
+                in_memory=estimate_measurement(metadata)
+            )
+        )
+    else:
+        table, stages = estimate_table_stages(measurements_csv)
+
+    # Scale the features for clustering chunk by chunk
+    # if the whole table does not fit in memory
+    leiden = stages.get("leiden")
+    if (
+        leiden is not None
+        and memory_budget > 0
+        and leiden["scaling"] == "robust"
+        and leiden["in_memory"] * HEADROOM > memory_budget
+    ):
+        logger.info("Switching leiden to scaling=robust_sketch to fit in memory")
+        leiden["scaling"] = "robust_sketch"
+
+    for name, stage in stages.items():
+        # The estimate for the mode which will be used
+        stage["mode"] = "streaming" if stage.get("scaling") == "robust_sketch" else "in_memory"
+        estimate = stage["streaming"] if stage["mode"] == "streaming" else stage["in_memory"]
+
+        # Memory to request from Nextflow (at most the memory available)
+        stage["memory"] = math.ceil(estimate * HEADROOM)
+        if memory_budget > 0:
+            stage["memory"] = min(stage["memory"], memory_budget)
+
+        logger.info(
+            f"{name}: {format_bytes(stage['in_memory'])} in memory, "
+            f"using {stage['mode']} mode (request {format_bytes(stage['memory'])})"
+        )
+        if memory_budget > 0 and estimate > memory_budget:
+            logger.warning(f"{name} may need more than {format_bytes(memory_budget)}")
+
+    logger.info(f"Writing {output_fp}")
+    with open(output_fp, "w") as f:
+        json.dump(
+            dict(
+                memory_budget=memory_budget if memory_budget > 0 else None,
+                **table,
+                stages=stages
+            ),
+            f,
+            indent=4
+        )
+
+
+def estimate_table_stages(measurements_csv: str) -> Tuple[dict, dict]:
+    """
+    Estimate the size of the measurement table,
+    and the peak memory of the stages which read it.
+    """
+
+    columns, n_rows = sample_table(measurements_csv)
+    n_features = count_features(columns, "${params.cluster_by}")
+    logger.info(f"Estimated {n_rows:,} cells, {len(columns):,} columns, {n_features:,} features")
+    table = dict(n_cells=n_rows, n_columns=len(columns), n_features=n_features)
+
+    n_neighbors = int("${params.cluster_n_neighbors}")
+    return table, dict(
+        split=dict(
+            in_memory=estimate_split(n_rows, len(columns))
+        ),
+        leiden=dict(
+            in_memory=estimate_leiden(n_rows, n_features, n_neighbors, streaming=False),
+            streaming=estimate_leiden(n_rows, n_features, n_neighbors, streaming=True),
+            scaling="${params.scaling}"
+        ),
+        spatialdata=dict(
+            in_memory=estimate_spatialdata(
+                n_rows,
+                n_features,
+                len(columns) - n_features,
+                n_workers=int("${params.spatialdata_cpus}"),
+                chunk_bytes=int("${params.zarr_chunk_bytes}")
+            )
+        )
+    )
+
+
+def sample_table(fp: str, sample_bytes=1 << 20) -> Tuple[List[str], int]:
+    """
+    Read the header of a CSV (which may be gzip-compressed) and estimate its
+    number of rows from the size of the file and the rows in its first block,
+    without reading the whole file.
+    """
+
+    size = os.path.getsize(fp)
+    with open(fp, "rb") as handle:
+        raw = handle.read(sample_bytes)
+
+    if fp.endswith(".gz"):
+        text = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(raw)
+    else:
+        text = raw
+    lines = text.splitlines()
+    columns = next(csv.reader([lines[0].decode("utf-8")]))
+
+    # The whole file was read
+    if len(raw) == size:
+        return columns, len([line for line in lines[1:] if len(line) > 0])
+
+    # The last line of the block is incomplete
+    n_sampled = max(len(lines) - 2, 1)
+    return columns, int(n_sampled * size / len(raw))
+
+
+def count_features(columns: List[str], cluster_by: str) -> int:
+    """
+    Count the columns used for clustering, e.g. cluster_by="Cell.Mean"
+    matches "Cell: DAPI: Mean" (as in split_measurements.py).
+    Falls back to all of the intensity columns if none match.
+    """
+
+    intensities = [
+        cname.split(": ")
+        for cname in columns
+        if len(cname.split(": ")) == 3
+    ]
+    n_features = sum(
+        f"{partition}.{measurement}" == cluster_by
+        for partition, _, measurement in intensities
+    )
+    return n_features if n_features > 0 else len(intensities)
+
+
+def estimate_measurement(metadata: dict) -> int:
+    """The image, the label image from cellpose and the outlines found from it are held in memory."""
+    n_values = int(np.prod(metadata["shape"]))
+    n_pixels = n_values // metadata["n_channels"]
+    return BYTES_PER_PROCESS + n_values * np.dtype(metadata["dtype"]).itemsize + n_pixels * BYTES_PER_MASK_PIXEL
+
+
+def estimate_split(n_rows: int, n_columns: int) -> int:
+    """The table is read in full, then copied into the partitions."""
+    return BYTES_PER_PROCESS + 2 * n_rows * n_columns * BYTES_PER_VALUE
+
+
+def estimate_leiden(n_rows: int, n_features: int, n_neighbors: int, streaming: bool) -> int:
+    """
+    The features are read, scaled (copying the table) and put in an AnnData object,
+    before building the neighbor graph. When streaming (robust_sketch),
+    only the scaled features are read back, as float32.
+    """
+    table = n_rows * n_features * (4 if streaming else 3 * BYTES_PER_VALUE)
+    return BYTES_PER_PROCESS + table + n_rows * n_neighbors * BYTES_PER_EDGE
+
+
+def estimate_spatialdata(
+    n_rows: int,
+    n_features: int,
+    n_attributes: int,
+    n_workers: int,
+    chunk_bytes: int
+) -> int:
+    """
+    The table and the cell and nucleus outlines are held in memory,
+    while the image and labels are read and written chunk by chunk.
+    """
+    table = n_rows * (n_features * 4 + n_attributes * BYTES_PER_VALUE)
+    outlines = 2 * n_rows * BYTES_PER_OUTLINE
+    return BYTES_PER_PROCESS + table + outlines + n_workers * chunk_bytes * CHUNK_COPIES
+
+
+def format_bytes(n_bytes: Union[int, float]) -> str:
+    """Format a number of bytes, e.g. 1.5 GB."""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n_bytes < 1024:
+            return f"{n_bytes:.1f} {unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} TB"
+
+
+main()
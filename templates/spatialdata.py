@@ -1,27 +1,41 @@
 #!/usr/local/bin/python3
 
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
 import shutil
 from geopandas import GeoDataFrame
-from numpy import array
 from rasterio.features import rasterize
-from shapely import Polygon
-from skimage.io import imread as sk_imread
+from rasterio.transform import Affine
+from itertools import chain
+from numcodecs import Blosc
 from multiscale_spatial_image.multiscale_spatial_image import MultiscaleSpatialImage
-from multiscale_spatial_image import to_multiscale
 from pathlib import Path
-from spatialdata.models import ShapesModel, TableModel, Image2DModel
-from spatialdata.transformations.transformations import Scale
+from spatialdata.models import ShapesModel, TableModel, Image2DModel, Labels2DModel
+from spatialdata.transformations.transformations import Identity, Scale
+from spatialdata._io import write_image, write_labels
 from spatialdata._io.format import ShapesFormatV01
-from tifffile import TiffFile, TiffPage
-from typing import List, Mapping, Tuple, Union
-from xml.etree import ElementTree
+from tifffile import imread as tiff_imread
+from zipfile import ZipFile, ZIP_STORED
+from typing import Callable, Iterator, List, Mapping, Optional, Tuple, Union
+from xarray import DataArray, DataTree
 import anndata as ad
+import dask
 import dask.array as da
 import gzip
+import hashlib
 import json
 import logging
+import numpy as np
+import os
+import pandas as pd
+import shapely
 import spatialdata
-import sys
+import tempfile
+import time
+import zarr
+import zlib
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -32,6 +46,8 @@ def read_table(fp: str, instance_key="${params.instance_key}") -> TableModel:
     """
     Read in the tablular elements of the spatial data
     and convert to a TableModel object.
+    Must stay identical to read_table in update_table.py, so that a replaced table
+    has the same instance key as the labels in the store (see tests/test_update_table.py).
     """
     logger.info(f"Reading in {fp} as AnnData")
     adata = ad.read_h5ad(fp)
@@ -44,6 +60,16 @@ def read_table(fp: str, instance_key="${params.instance_key}") -> TableModel:
     if not instance_key in adata.obs.columns:
         raise ValueError(f"Instance key {instance_key} not found in obs")
 
+    # The label images need positive integer IDs for each cell
+    if not (
+        pd.api.types.is_integer_dtype(adata.obs[instance_key])
+        and adata.obs[instance_key].min() > 0
+    ):
+        logger.info(f"Values of {instance_key} are not positive integers, adding label_id")
+        adata.obs["label_id"] = np.arange(1, adata.n_obs + 1, dtype="uint32")
+        instance_key = "label_id"
+        logger.info(f"Using instance_key={instance_key}")
+
     return TableModel.parse(
         adata,
         region="cell_boundaries",
@@ -52,83 +78,152 @@ def read_table(fp: str, instance_key="${params.instance_key}") -> TableModel:
     )
 
 
-def has_geometry(
-    geo_json: List[dict],
-    val: str
-) -> bool:
+def iter_geo_json(fp: str, chunk_size=1 << 22) -> Iterator[dict]:
     """
-    Check if the geometry is present in the GeoJSON.
+    Stream the features of a gzip-compressed GeoJSON file one at a time,
+    without loading the whole file. The file is expected to contain a list
+    of features. A FeatureCollection is supported, but is read in full.
     """
-    return all(
-        val in cell
-        for cell in geo_json
-    )
 
+    decoder = json.JSONDecoder()
+    with gzip.open(fp, "rt") as handle:
+        buf = handle.read(chunk_size).lstrip()
+
+        if buf.startswith("{"):
+            logger.info("Reading GeoJSON FeatureCollection")
+            yield from json.loads(buf + handle.read())["features"]
+            return
+
+        if not buf.startswith("["):
+            raise ValueError(f"Expected a list of GeoJSON features in {fp}")
+
+        pos = 1
+        while True:
+            # Skip to the start of the next feature
+            while pos < len(buf) and buf[pos] in " \\t\\n\\r,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+
+            # Decode the next feature, reading more of the file
+            # if it is not complete in the buffer
+            try:
+                feature, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                more = handle.read(chunk_size)
+                if len(more) == 0:
+                    raise ValueError(f"Could not parse the GeoJSON features in {fp}")
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+
+            yield feature
+
+
+def read_geo_json(
+    fp: str,
+    kws: List[str]
+) -> Tuple[list, Mapping[str, Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Read the cell outlines from a GeoJSON file in a single streaming pass.
 
-def _is_list_of_points(coordinates: list) -> bool:
-    return (
-        isinstance(coordinates, list)
-        and len(coordinates) > 0
-        and all(isinstance(point, list) for point in coordinates)
-        and all([len(point) == 2 for point in coordinates])
-        and all([isinstance(val, (int, float)) for point in coordinates for val in point])
-    )
+    Returns the ID of every cell and, for each of the geometry keywords
+    which is present for every cell, a tuple with the (n, 2) array of
+    the points of every outline and the number of points in each outline.
+    """
 
+    ids = []
+    coords = {kw: array("d") for kw in kws}
+    lengths = {kw: array("q") for kw in kws}
 
-def unpack_extra_dimensions(coordinates: list) -> list:
-    """Unpack the coordinates until there is a single list of 2D points."""
+    for cell in iter_geo_json(fp):
+        ids.append(cell["id"])
+        for kw in kws:
+            if kw in cell:
+                ring = unpack_extra_dimensions(cell[kw]["coordinates"])
+                lengths[kw].append(len(ring))
+                coords[kw].extend(chain.from_iterable(ring))
+    logger.info(f"Read {len(ids):,} cells")
 
-    while len(coordinates) > 0:
-        if _is_list_of_points(coordinates):
-            return coordinates
-        else:
-            coordinates = coordinates[0]
+    geometries = dict()
+    for kw in kws:
+
+        # Only use geometries which are present for every cell
+        if len(lengths[kw]) < len(ids):
+            logger.info(f"Geometry {kw} found for {len(lengths[kw]):,} cells - skipping")
+            continue
 
+        kw_coords = np.frombuffer(coords[kw], dtype=np.float64)
+        kw_lengths = np.frombuffer(lengths[kw], dtype=np.int64)
+        if kw_coords.shape[0] != 2 * kw_lengths.sum():
+            raise ValueError(f"All points in {kw} must have two coordinates")
+        geometries[kw] = (kw_coords.reshape(-1, 2), kw_lengths)
 
-def make_polygon(cell: dict, kw: str) -> Polygon:
-    # Get the array of coordinates
-    coordinates: list = cell[kw]["coordinates"]
+    return ids, geometries
 
-    # Unpack extra dimensions
-    coordinates = unpack_extra_dimensions(coordinates)
 
-    # If the last set of points is the same as the first, remove it
-    if (
-        len(coordinates) > 1
-        and coordinates[0][0] == coordinates[-1][0]
-        and coordinates[0][1] == coordinates[-1][1]
+def unpack_extra_dimensions(coordinates: list) -> list:
+    """Unpack the coordinates until there is a single list of 2D points."""
+
+    while (
+        len(coordinates) > 0
+        and isinstance(coordinates[0], list)
+        and (len(coordinates[0]) == 0 or isinstance(coordinates[0][0], list))
     ):
-        coordinates.pop(-1)
+        coordinates = coordinates[0]
+    return coordinates
 
-    # Make the polygon
-    try:
-        polygon = Polygon(array(coordinates))
-    except ValueError as e:
-        logger.info(f"Error parsing cell {cell['id']}")
-        logger.info(cell[kw]["coordinates"])
-        logger.info(coordinates)
-        raise e
-    return polygon
+
+def make_polygons(
+    ids: list,
+    coords: np.ndarray,
+    lengths: np.ndarray
+) -> np.ndarray:
+    """
+    Build polygons in bulk from the points of every ring, concatenated
+    into a single (n, 2) array, and the number of points in each ring.
+    Rings may or may not repeat their first point at the end.
+    """
+
+    # Count the distinct points in each ring, ignoring a repeated last point
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    closed = np.zeros(len(lengths), dtype=bool)
+    multi = lengths > 1
+    closed[multi] = (
+        coords[offsets[:-1][multi]] == coords[offsets[1:][multi] - 1]
+    ).all(axis=1)
+    n_points = lengths - closed
+
+    # Report all of the invalid rings at once
+    invalid = np.flatnonzero(n_points < 3)
+    if len(invalid) > 0:
+        examples = ", ".join(str(ids[ix]) for ix in invalid[:10])
+        raise ValueError(
+            f"Found {len(invalid):,} shapes with fewer than 3 points (e.g. {examples})"
+        )
+
+    # Rings which are not closed will be closed by shapely
+    rings = shapely.linearrings(
+        coords,
+        indices=np.repeat(np.arange(len(lengths)), lengths)
+    )
+    return shapely.polygons(rings)
 
 
 def parse_geo_json(
-    geo_json: List[dict],
+    ids: list,
+    coords: np.ndarray,
+    lengths: np.ndarray,
     kw: str,
     pixel_size=1.0
 ) -> GeoDataFrame:
 
     logger.info(f"Parsing GeoJson - {kw} (pixel_size={pixel_size})")
 
-    geo_df = (
-        GeoDataFrame([
-            dict(
-                id=cell["id"],
-                geometry=make_polygon(cell, kw)
-            )
-            for cell in geo_json
-        ])
-        .set_index("id")
-    )
+    geo_df = GeoDataFrame(
+        dict(id=ids),
+        geometry=make_polygons(ids, coords, lengths)
+    ).set_index("id")
     scale = Scale(
         [1.0 / pixel_size, 1.0 / pixel_size],
         axes=("x", "y")
@@ -140,6 +235,134 @@ def parse_geo_json(
     )
 
 
+def align_to_table(mask_geo: GeoDataFrame, instance_ids: pd.Series) -> np.ndarray:
+    """
+    Put the outlines of the cells in the same order as the rows of the table,
+    with an empty polygon for any cell without an outline.
+    """
+
+    geometry = mask_geo.geometry.copy()
+    geometry.index = geometry.index.astype(str)
+    n_skipped = (~geometry.index.isin(instance_ids.index)).sum()
+    if n_skipped > 0:
+        logger.info(f"Skipping {n_skipped:,} shapes which are not in the table")
+
+    geometry = geometry.reindex(instance_ids.index).values
+    geometry[shapely.is_missing(geometry)] = shapely.Polygon()
+    return geometry
+
+
+class PackedRTree:
+    """
+    A static R-tree over the bounding boxes of a set of items, packed with
+    the Sort-Tile-Recursive algorithm into flat arrays, so that it can be
+    saved alongside the shapes in the Zarr store.
+
+    - boxes: the (xmin, ymin, xmax, ymax) of every node, level by level,
+      starting with the items themselves (in packed order)
+    - order: the index of the item for each box in the first level
+    - level_offsets: the position in boxes of the first node of each level
+
+    Node j of each level covers nodes [j * node_size, (j + 1) * node_size)
+    of the level below, so finding the items in a region is O(log n + k).
+    """
+
+    def __init__(self, bounds: np.ndarray, node_size=16):
+        self.node_size = node_size
+
+        # Items without a shape (NaN bounds) are never found
+        bounds = np.array(bounds, dtype="float64").reshape(-1, 4)
+        missing = np.isnan(bounds).any(axis=1)
+        bounds[missing] = [np.inf, np.inf, -np.inf, -np.inf]
+
+        # Sort the items into vertical slices by x, and then by y in each slice
+        n_items = len(bounds)
+        n_slices = int(np.ceil(np.sqrt(np.ceil(n_items / node_size))))
+        center_x = np.where(missing, np.inf, (bounds[:, 0] + bounds[:, 2]) / 2)
+        center_y = np.where(missing, np.inf, (bounds[:, 1] + bounds[:, 3]) / 2)
+        order = np.argsort(center_x, kind="stable")
+        slices = np.arange(n_items) // max(1, n_slices * node_size)
+        self.order = order[np.lexsort((center_y[order], slices))]
+
+        # Each level of nodes bounds consecutive groups of the level below
+        levels = [bounds[self.order]]
+        while len(levels[-1]) > 1:
+            prev = levels[-1]
+            starts = np.arange(0, len(prev), node_size)
+            levels.append(np.column_stack([
+                np.minimum.reduceat(prev[:, 0], starts),
+                np.minimum.reduceat(prev[:, 1], starts),
+                np.maximum.reduceat(prev[:, 2], starts),
+                np.maximum.reduceat(prev[:, 3], starts)
+            ]))
+
+        self.boxes = np.concatenate(levels)
+        self.level_offsets = np.cumsum([0] + [len(level) for level in levels]).tolist()
+
+    def _level(self, level: int) -> np.ndarray:
+        return self.boxes[self.level_offsets[level]:self.level_offsets[level + 1]]
+
+    def query(self, xmin: float, ymin: float, xmax: float, ymax: float) -> np.ndarray:
+        """Return the index of every item whose bounds intersect a box."""
+
+        top = len(self.level_offsets) - 2
+        nodes = np.arange(len(self._level(top)))
+        for level in range(top, -1, -1):
+            boxes = self._level(level)[nodes]
+            nodes = nodes[
+                (boxes[:, 0] <= xmax) & (boxes[:, 1] <= ymax) &
+                (boxes[:, 2] >= xmin) & (boxes[:, 3] >= ymin)
+            ]
+            if level > 0:
+                children = (nodes[:, None] * self.node_size + np.arange(self.node_size)).ravel()
+                nodes = children[children < len(self._level(level - 1))]
+
+        return self.order[nodes]
+
+    def to_zarr(self, group: zarr.Group, **attrs):
+        """Save the tree as arrays in a Zarr group."""
+        group.array("boxes", self.boxes, chunks=(1 << 16, 4))
+        group.array("order", self.order, chunks=(1 << 16,))
+        group.attrs.update(
+            node_size=self.node_size,
+            level_offsets=self.level_offsets,
+            **attrs
+        )
+
+
+def make_lod_shapes(
+    geometry: np.ndarray,
+    instance_ids: pd.Series,
+    tolerances: List[float],
+    n_workers=1
+) -> List[GeoDataFrame]:
+    """
+    Simplify the outlines of the cells (in the order of the table) at each
+    of the tolerances (in pixels), preserving their topology.
+    """
+
+    # Shapely releases the GIL, so the outlines are simplified in parallel
+    parts = np.array_split(geometry, max(1, n_workers))
+
+    lod_shapes = []
+    for tolerance in tolerances:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            simplified = np.concatenate(list(pool.map(
+                lambda part: shapely.simplify(part, tolerance, preserve_topology=True),
+                parts
+            )))
+        n_vertices = shapely.get_num_coordinates(simplified).sum()
+        logger.info(f"Simplified outlines (tolerance={tolerance}): {n_vertices:,} vertices")
+
+        # The outlines are in pixel coordinates, like the image and labels
+        lod_shapes.append(ShapesModel.parse(
+            GeoDataFrame(geometry=simplified, index=instance_ids.index),
+            transformations={"global": Identity()}
+        ))
+
+    return lod_shapes
+
+
 def make_spatial_points(
     table: ad.AnnData,
     instance_key="object_id",
@@ -161,153 +384,148 @@ def make_spatial_points(
     return points
 
 
-def read_tif_channel_names(tmp_file: str, n_channels: int) -> List[str]:
-    """Parse channel names from a TIF file."""
-
-    # Try to parse QPTIFF metadata
-    logger.info("Parsing QPTIFF metadata")
-    channel_names = parse_qptiff_metadata(tmp_file)
-
-    # If no names were found
-    if channel_names is None:
-        logger.info("No channel names found from QPTIFF format")
-
-        # Try to parse OME metadata
-        logger.info("Parsing OME-TIFF metadata")
-        channel_names = parse_ome_metadata(tmp_file)
-
-    if channel_names is None:
-        logger.info("No OME-TIFF metadata found")
-
-    elif len(channel_names) > 0:
-        logger.info("Parsed channel names")
-        for cname in channel_names:
-            logger.info(cname)
-
-    # Fallback if metadata was not parsed appropriately
-    if channel_names is None or len(channel_names) != n_channels:
-
-        logger.info("Falling back to numerically indexed channels")
-
-        # The channels are just named numerically (1-indexed)
-        channel_names = [
-            str(ix + 1)
-            for ix in range(n_channels)
-        ]
-
-    return channel_names
-
-
-def parse_qptiff_metadata(tmp_file) -> List[str]:
-    """Parse channel names from QPTIFF."""
-
-    with TiffFile(tmp_file) as tif:
-        channel_names = [
-            parse_qptiff_metadata_page(page)
-            for page in tif.series[0].pages
-        ]
+class ChunkCheckpoint:
+    """
+    Zarr store in which the levels of the image and label pyramids are
+    written chunk by chunk, recording each completed chunk (with the CRC-32
+    of its file) in a manifest. When a run is interrupted, the next run
+    using the same store skips the chunks which are listed in the manifest
+    and still match their checksum.
+
+    Parameters
+    ----------
+    path : str
+        Location of the store (created if needed)
+    n_workers : int
+        Number of chunks computed and written in parallel
+    batch_size : int
+        Number of chunks written between each update of the manifest
+    compressor : Blosc or None
+        Codec used to encode the chunks (None for uncompressed chunks)
+    """
 
-    # If metadata could not be parsed, return None
-    for cn in channel_names:
-        if cn is None:
+    def __init__(self, path, n_workers=1, batch_size=64, compressor=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.compressor = compressor
+        self.manifest_fp = self.path / "manifest.jsonl"
+        self.done = self._read_manifest()
+
+        # Elements which are not written to the checkpoint (e.g. a cached image)
+        self.exclude = set()
+
+    def _read_manifest(self) -> set:
+        """Read the chunks listed in the manifest, keeping those which can be verified."""
+
+        done = set()
+        if not self.manifest_fp.exists():
+            return done
+
+        n_invalid = 0
+        with open(self.manifest_fp) as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line is incomplete if the run was killed while writing it
+                    continue
+                if self._checksum(entry["array"], entry["chunk"]) == entry["crc32"]:
+                    done.add((entry["array"], entry["chunk"]))
+                else:
+                    n_invalid += 1
+
+        logger.info(f"Verified {len(done):,} chunks in {self.manifest_fp} ({n_invalid:,} failed)")
+        return done
+
+    def _checksum(self, name: str, chunk: str) -> Union[int, None]:
+        """CRC-32 of the file of a chunk, or None if it is missing."""
+        fp = self.path / name / chunk
+        if not fp.exists():
             return None
+        return zlib.crc32(fp.read_bytes())
+
+    def _append(self, entries: List[dict]):
+        """Add chunks to the manifest, making sure that they reach the disk."""
+        with open(self.manifest_fp, "a") as handle:
+            for entry in entries:
+                print(json.dumps(entry), file=handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+    def writer(self, element: str) -> Union[None, Callable[[DataArray, int], DataArray]]:
+        """Function which writes each level of a pyramid to {element}/scale{ix}."""
+        if element in self.exclude:
+            return None
+        return lambda level, ix: self.write(level, f"{element}/scale{ix}")
+
+    def write(self, level: DataArray, name: str) -> DataArray:
+        """
+        Compute and write the chunks of a level which are not already complete,
+        returning the level backed by the array in the store.
+        """
+
+        data = level.data
+        arr = zarr.open_array(
+            str(self.path / name),
+            mode="a",
+            shape=data.shape,
+            chunks=data.chunksize,
+            dtype=data.dtype,
+            compressor=self.compressor,
+            fill_value=0,
+            write_empty_chunks=True
+        )
+        if arr.shape != data.shape or arr.chunks != data.chunksize or arr.dtype != data.dtype:
+            raise ValueError(f"{self.path / name} does not match the level being written")
+
+        # Chunks which were not completed by a previous run
+        pending = [
+            ix
+            for ix in np.ndindex(*data.numblocks)
+            if (name, ".".join(map(str, ix))) not in self.done
+        ]
+        n_chunks = int(np.prod(data.numblocks))
+        logger.info(f"Writing {name} {data.shape} ({len(pending):,} of {n_chunks:,} chunks)")
 
-    return channel_names
-
-
-def parse_qptiff_metadata_page(page: TiffPage) -> Union[str, None]:
-    """Parse a single channel name from QPTIFF."""
-
-    # Catch errors when there is no page.description
-    if not hasattr(page, "description"):
-        return None
-
-    # Parse the XML
-    try:
-        dat = ElementTree.fromstring(page.description)
-    except ElementTree.ParseError:
-        logger.info("Could not parse XML from file")
-        return None
-
-    # Try different keywords
-    for kw in [
-        "Biomarker",
-        "Name"
-    ]:
-        elem = dat.find(kw)
-        if elem is not None:
-            return elem.text
-
-
-def _parse_ome_xml(tmp_file: Path) -> Union[None, List[str]]:
-    """Try to read the OME-XML metadata from a TIFF file."""
-
-    # Try to read OME metadata
-    with TiffFile(tmp_file) as tif:
-        ome_metadata = tif.ome_metadata
-
-    if ome_metadata is None:
-        return None
-
-    # Parse the metadata
-    try:
-        root = ElementTree.fromstring(ome_metadata)
-    except ElementTree.ParseError:
-        logger.info("Could not parse XML from file")
-        return None
-    
-    return root
-    
-
-def parse_ome_metadata(tmp_file: Path) -> Union[None, List[str]]:
-    """Parse channel names from OME-TIFF."""
-
-    # Try to read OME metadata
-    root = _parse_ome_xml(tmp_file)
-    if root is None:
-        return
-
-    # Try to get the channel names using the OME schema
-    channel_names = [
-        elem.attrib["Name"]
-        for elem in root.iter("{http://www.openmicroscopy.org/Schemas/OME/2016-06}Channel")
-        if elem.attrib.get("Name") is not None
-    ]
-    if len(channel_names) > 0:
-        return channel_names
+        offsets = [np.cumsum((0,) + dim_chunks) for dim_chunks in data.chunks]
 
-    # Fall back to any list of Names
-    return _find_name_list(root)
+        def _write_chunk(ix: Tuple[int]) -> dict:
+            region = tuple(
+                slice(dim_offsets[i], dim_offsets[i + 1])
+                for dim_offsets, i in zip(offsets, ix)
+            )
+            arr[region] = data.blocks[ix].compute(scheduler="synchronous")
+            chunk = ".".join(map(str, ix))
+            return dict(array=name, chunk=chunk, crc32=self._checksum(name, chunk))
 
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            for start in range(0, len(pending), self.batch_size):
+                entries = list(executor.map(_write_chunk, pending[start:start + self.batch_size]))
+                self._append(entries)
+                self.done.update((entry["array"], entry["chunk"]) for entry in entries)
 
-def _find_name_list(elem: ElementTree.Element) -> Union[None, List[str]]:
-    names = [
-        ch.attrib["Name"]
-        for ch in elem
-        if ch.attrib.get("Name") is not None
-    ]
-    if len(names) > 0:
-        return names
-    else:
-        for ch in elem:
-            if _find_name_list(ch) is not None:
-                return _find_name_list(ch)
+        return level.copy(data=da.from_zarr(arr))
 
 
 def downscale_image(
-    image,
+    image: DataArray,
+    source_levels: Optional[List[da.Array]] = None,
     scale_factor=2,
     min_px=400,
-    chunk_x=300,
-    chunk_y=300,
-    chunk_c=1
+    chunk_x=512,
+    chunk_y=512,
+    chunk_c=1,
+    method="mean",
+    checkpoint: Callable[[DataArray, int], DataArray] = None
 ) -> MultiscaleSpatialImage:
 
     # Pick the number of scales so that the smallest
     # is no smaller than min_px
     scales = [scale_factor]
     while (
-        min(image.shape[1], image.shape[2]) /
+        min(image.sizes["y"], image.sizes["x"]) /
         (scale_factor**len(scales))
     ) > min_px:
         scales.append(scale_factor)
@@ -315,49 +533,116 @@ def downscale_image(
 
     # Convert to multiscale
     # Set chunks on each level of scale
-    chunks = dict(c=chunk_c, x=chunk_x, y=chunk_y)
+    chunks = {
+        dim: size
+        for dim, size in dict(c=chunk_c, x=chunk_x, y=chunk_y).items()
+        if dim in image.dims
+    }
     chunks_str = json.dumps(chunks)
-    params = f"scales={scales_str}; chunks={chunks_str}"
+    params = f"scales={scales_str}; chunks={chunks_str}; method={method}"
     logger.info(f"Converting to multiscale ({params})")
-    return to_multiscale(
-        image,
-        scales,
-        chunks=chunks
-    )
 
+    if source_levels is None:
+        source_levels = []
 
-def read_tif(
-    tmp_file: str,
-    table: ad.AnnData,
-    shapes:  Mapping[str, GeoDataFrame],
-    masks: Mapping[str, GeoDataFrame],
-    min_px=400,
-    scale_factor=2,
-    chunk_x=300,
-    chunk_y=300,
-    chunk_c=1
-) -> Tuple[spatialdata.SpatialData, dict]:
+    # Each level is written to the checkpoint (if any) before the next
+    # is computed from it, so that an interrupted run can resume
+    if checkpoint is None:
+        checkpoint = lambda level, ix: level
+
+    levels = [checkpoint(image.chunk(chunks), 0)]
+    for ix, factor in enumerate(scales):
+        prev = levels[-1]
+        coarsened = downsample_level(prev, factor, method)
+
+        # Use a level from the source file if it has the same shape
+        source = pick_source_level(source_levels, coarsened.shape)
+        if source is None:
+            logger.info(f"Computing scale{ix + 1} {coarsened.shape}")
+            level = coarsened
+        else:
+            logger.info(f"Reusing source pyramid level for scale{ix + 1} {coarsened.shape}")
+            level = reuse_source_level(source, coarsened)
+
+        levels.append(checkpoint(level.chunk(chunks), ix + 1))
+
+    return DataTree.from_dict({
+        f"scale{ix}": level.to_dataset(name=image.name, promote_attrs=True)
+        for ix, level in enumerate(levels)
+    })
+
+
+def downsample_level(level: DataArray, factor: int, method: str) -> DataArray:
     """
-    Read in a TIF file
+    Downsample a pyramid level along y and x.
+
+    The "mean" method matches the xarray_coarsen method used by to_multiscale.
+    The "nearest" method takes every nth pixel, which preserves the values
+    of label images.
     """
+    if method == "mean":
+        return (
+            level
+            .coarsen(y=factor, x=factor, boundary="trim", side="right")
+            .mean()
+            .astype(level.dtype)
+        )
+    elif method == "nearest":
+        return level.isel(
+            y=slice(0, (level.sizes["y"] // factor) * factor, factor),
+            x=slice(0, (level.sizes["x"] // factor) * factor, factor)
+        )
+    else:
+        raise ValueError(f"Unknown downsampling method: {method}")
 
-    # If there are backslashes in the path, remove them and inform the user
-    if "\\\\" in tmp_file:
-        logger.info(f"Removing backslashes from file path ({tmp_file})")
-        tmp_file = tmp_file.replace("\\\\", "")
-        logger.info(f"New file path: {tmp_file}")
 
-    logger.info(f"Reading TIF image from {tmp_file}")
+def pick_source_level(
+    source_levels: List[da.Array],
+    shape: Tuple[int, int, int]
+) -> Union[da.Array, None]:
+    """
+    Pick the sub-resolution level of the source file which matches the
+    shape (c, y, x) of a pyramid level, allowing for the source file to
+    round up the size of each axis.
+    """
+    for source in source_levels:
+        if (
+            source.shape[0] == shape[0]
+            and 0 <= source.shape[1] - shape[1] <= 1
+            and 0 <= source.shape[2] - shape[2] <= 1
+        ):
+            return source
+
+
+def reuse_source_level(source: da.Array, coarsened: DataArray) -> DataArray:
+    """
+    Wrap a source pyramid level with the coordinates and attributes
+    of the equivalent coarsened level.
+    """
+    return coarsened.copy(
+        data=source[:, :coarsened.shape[1], :coarsened.shape[2]].astype(coarsened.dtype)
+    )
 
-    # Read the image
-    try:
-        image = sk_imread(tmp_file, plugin="tifffile")
-    except MemoryError as e:
-        logger.info(str(e))
-        logger.info("Exiting: 137")
-        sys.exit(137)
-    logger.info("Converting to array")
-    image = da.from_array(image)
+
+def read_tif_levels(tmp_file: str, cax: int, n_levels: int) -> List[da.Array]:
+    """
+    Lazily open any sub-resolution levels of a TIF file
+    (e.g. from QPTIFF or pyramidal OME-TIFF).
+    """
+    levels = []
+    for level in range(1, n_levels):
+        image, _ = orient_image(open_tif_lazy(tmp_file, level=level), cax=cax)
+        logger.info(f"Found source pyramid level {level}: {image.shape}")
+        levels.append(image)
+    return levels
+
+
+def orient_image(image: da.Array, cax=None) -> Tuple[da.Array, int]:
+    """
+    Reshape an image to three dimensions with the color axis first.
+    Unless specified, the color axis is assumed to be the shortest one.
+    Returns the reshaped image and the original index of the color axis.
+    """
 
     # The array must have at least two dimensions
     assert len(image.shape) >= 2, "Image must have at least two dimensions"
@@ -381,68 +666,209 @@ def read_tif(
     assert len(image.shape) == 3, "Can only display three dimensions"
 
     # Find the shortest dimension (which we assume is color)
-    cax = image.shape.index(min(image.shape))
+    if cax is None:
+        cax = image.shape.index(min(image.shape))
 
     # If it's not the first one, move it
     if cax != 0:
         logger.info(f"Moving axis {cax} to position 0")
         image = da.moveaxis(image, cax, 0)
 
-    # Read the channel names
-    logger.info(f"Parsing channel names from {tmp_file}")
-    channel_names = read_tif_channel_names(tmp_file, image.shape[0])
-    for cname in channel_names:
-        logger.info(cname)
-
-    # If there are masks
-    mask_channels = dict()
-    if masks is not None:
-
-        # Add the masks as image channels
-        for mask_name, mask_geo in masks.items():
-
-            mask_channels[mask_name] = image.shape[0]
-
-            # Add a new color channel with the rasterized shapes
-            image = da.concatenate(
-                [
-                    image,
-                    da.expand_dims(
-                        rasterize(
-                            mask_geo.geometry,
-                            default_value=1,
-                            fill=0,
-                            out_shape=image.shape[1:],
-                            all_touched=True,
-                            dtype=image.dtype
-                        ),
-                        axis=0
-                    )
-                ],
-                axis=0
-            )
+    return image, cax
+
+
+def open_tif_lazy(tmp_file: str, level=0) -> da.Array:
+    """
+    Open one resolution level of a TIF file as a dask array
+    which is backed by the native tiles (or strips) of the file.
+    No pixel data is read until the array is computed.
+    """
+    store = tiff_imread(tmp_file, aszarr=True, level=level)
+    tiles = zarr.open(store, mode="r")
+
+    # Use from_array rather than from_zarr, since the TIF store is not a
+    # file-backed zarr store which SpatialData could resolve on write
+    return da.from_array(
+        tiles,
+        chunks=tiles.chunks,
+        name=f"tif-{Path(tmp_file).name}-level{level}",
+        inline_array=True
+    )
+
+
+def rasterize_lazy(
+    geoms: np.ndarray,
+    shape: Tuple[int, int],
+    chunks: Tuple[Tuple[int, ...], Tuple[int, ...]],
+    values: Union[np.ndarray, None] = None,
+    dtype="uint8",
+    tree: Union[PackedRTree, None] = None
+) -> da.Array:
+    """
+    Lazily rasterize shapes onto a (y, x) pixel grid, one chunk at a time.
+    Each chunk only burns in the shapes whose bounds intersect it,
+    which are found using a spatial index over all of the shapes
+    (built here unless provided).
+    Each shape is filled with the matching element of `values` (default: 1).
+    """
+
+    if values is None:
+        values = np.ones(len(geoms), dtype=dtype)
+    if tree is None:
+        tree = PackedRTree(shapely.bounds(geoms))
+
+    def _rasterize_block(block: np.ndarray, block_info=None) -> np.ndarray:
+        (y0, y1), (x0, x1) = block_info[0]["array-location"]
+        # Burn in the shapes in the same (input) order in every chunk, so that
+        # overlapping shapes are resolved the same way whatever the chunk size
+        ixs = np.sort(tree.query(x0, y0, x1, y1))
+        if len(ixs) == 0:
+            return block
+        return rasterize(
+            zip(geoms[ixs], values[ixs]),
+            fill=0,
+            out_shape=block.shape,
+            transform=Affine.translation(x0, y0),
+            all_touched=True,
+            dtype=dtype
+        )
+
+    return da.zeros(shape, chunks=chunks, dtype=dtype).map_blocks(
+        _rasterize_block,
+        dtype=dtype
+    )
+
+
+def pick_chunk_size(
+    shape: Tuple[int, int, int],
+    dtype: np.dtype,
+    tile_shape: Tuple[int, int],
+    chunk_c=1,
+    target_bytes=1 << 20,
+    align=256
+) -> int:
+    """
+    Pick the width and height of the (square) chunks of the multiscale image
+    so that each chunk holds roughly target_bytes of pixel data.
+
+    The size is rounded down to a multiple of the tile size of the source
+    file (if it is tiled), so that each chunk reads whole tiles, or
+    otherwise to a multiple of align (matching 256/512 px viewer tiles).
+    """
+
+    n_channels, height, width = shape
+    pixel_bytes = np.dtype(dtype).itemsize * min(chunk_c, n_channels)
+    size = int(np.sqrt(target_bytes / pixel_bytes))
+
+    # Tiled files have square tiles which do not span the whole width
+    tile_y, tile_x = tile_shape
+    if tile_y == tile_x and tile_x < width:
+        step = tile_x
+    else:
+        step = align
+    size = max(step, size // step * step)
 
-            # Add the channel name
-            channel_names.append(mask_name)
+    # There is no need for chunks larger than the image
+    size = min(size, int(np.ceil(max(height, width) / step)) * step)
+
+    n_chunks = int(np.ceil(height / size) * np.ceil(width / size) * np.ceil(n_channels / chunk_c))
+    logger.info(f"Using {size}x{size} px chunks ({n_chunks:,} chunks in the full resolution image)")
+    return size
+
+
+def read_tif(
+    tmp_file: str,
+    table: ad.AnnData,
+    shapes:  Mapping[str, GeoDataFrame],
+    masks: Mapping[str, np.ndarray],
+    instance_ids: pd.Series,
+    spatial_index: Mapping[str, PackedRTree],
+    metadata: dict,
+    min_px=400,
+    scale_factor=2,
+    chunk_size="${params.zarr_chunk_size}",
+    chunk_bytes="${params.zarr_chunk_bytes}",
+    chunk_c=1,
+    checkpoint: ChunkCheckpoint = None
+) -> Tuple[spatialdata.SpatialData, dict]:
+    """
+    Read in a TIF file, using the metadata
+    which was parsed by tiff_metadata.py
+    """
+
+    # If there are backslashes in the path, remove them and inform the user
+    if "\\\\" in tmp_file:
+        logger.info(f"Removing backslashes from file path ({tmp_file})")
+        tmp_file = tmp_file.replace("\\\\", "")
+        logger.info(f"New file path: {tmp_file}")
+
+    logger.info(f"Reading TIF image from {tmp_file}")
+
+    # Lazily open the image, reading pixels tile by tile
+    image = open_tif_lazy(tmp_file)
+    logger.info(f"Image shape: {image.shape}, dtype: {image.dtype}, chunks: {image.chunksize}")
+    image, cax = orient_image(image)
+
+    # Any downsampled levels already in the file can be reused in the pyramid
+    source_levels = read_tif_levels(tmp_file, cax, len(metadata["levels"]))
+
+    channel_names = metadata["channel_names"]
+    assert len(channel_names) == image.shape[0], (
+        f"Expected {image.shape[0]} channel names, found {len(channel_names)}"
+    )
+    logger.info(f"Channel names: {', '.join(channel_names)}")
+
+    # Use the chunk size provided by the user, or pick one
+    # from the shape and dtype of the image and its tiles
+    chunk_size = int(chunk_size)
+    if chunk_size <= 0:
+        chunk_size = pick_chunk_size(
+            image.shape,
+            image.dtype,
+            tile_shape=image.chunksize[1:],
+            chunk_c=chunk_c,
+            target_bytes=int(chunk_bytes)
+        )
+    chunks = dict(
+        chunk_x=chunk_size,
+        chunk_y=chunk_size,
+        chunk_c=chunk_c
+    )
+
+    # Rasterize the masks as label images (e.g. cell_labels),
+    # which are only computed chunk by chunk as the pyramid is written
+    # (or as each level is written to the checkpoint)
+    labels = dict()
+    for mask_name, geometry in (masks or {}).items():
+        labels[f"{mask_name}_labels"] = format_spatial_labels(
+            geometry,
+            instance_ids,
+            spatial_index[f"{mask_name}_boundaries"],
+            shape=image.shape[1:],
+            scale_factor=scale_factor,
+            min_px=min_px,
+            chunks=chunks,
+            checkpoint=checkpoint,
+            name=f"{mask_name}_labels"
+        )
 
     # Convert the image to multiscale and build an
     # image model which can be used in a SpatialData object
     image = format_spatial_image(
         image,
         channel_names,
+        source_levels,
         scale_factor,
         min_px,
-        chunks=dict(
-            chunk_x=chunk_x,
-            chunk_y=chunk_y,
-            chunk_c=chunk_c
-        )
+        chunks=chunks,
+        checkpoint=checkpoint
     )
 
     # Convert to SpatialData
     logger.info("Converting to SpatialData")
     sdata = spatialdata.SpatialData(
         images=dict(image=image),
+        labels=labels,
         shapes=shapes,
         tables=dict(table=table)
     )
@@ -454,9 +880,11 @@ def read_tif(
 def format_spatial_image(
     image,
     channel_names,
+    source_levels,
     scale_factor,
     min_px,
-    chunks
+    chunks,
+    checkpoint: ChunkCheckpoint = None
 ):
 
     # Build the image model
@@ -474,8 +902,10 @@ def format_spatial_image(
     image: MultiscaleSpatialImage = (
         downscale_image(
             image,
+            source_levels=source_levels,
             min_px=min_px,
             scale_factor=scale_factor,
+            checkpoint=checkpoint.writer("images/image") if checkpoint else None,
             **chunks
         )
     )
@@ -483,40 +913,98 @@ def format_spatial_image(
     return image
 
 
+def format_spatial_labels(
+    geometry: np.ndarray,
+    instance_ids: pd.Series,
+    tree: PackedRTree,
+    shape: Tuple[int, int],
+    scale_factor,
+    min_px,
+    chunks,
+    checkpoint: ChunkCheckpoint = None,
+    name="labels"
+):
+    """
+    Rasterize shapes (in the order of the table) as a multiscale label image,
+    where the value of each pixel is the instance ID of the cell in the table
+    (0 for background).
+    """
+
+    labels = rasterize_lazy(
+        geometry,
+        shape=shape,
+        chunks=(chunks["chunk_y"], chunks["chunk_x"]),
+        values=instance_ids.values.astype("uint32"),
+        dtype="uint32",
+        tree=tree
+    )
+
+    # Build the labels model
+    logger.info("Building Labels2DModel")
+    labels = Labels2DModel.parse(labels, dims=('y', 'x'))
+
+    # Convert to multiscale using nearest-neighbor downsampling,
+    # with the same number of scales as the image
+    return downscale_image(
+        labels,
+        min_px=min_px,
+        scale_factor=scale_factor,
+        method="nearest",
+        checkpoint=checkpoint.writer(f"labels/{name}") if checkpoint else None,
+        **chunks
+    )
+
+
 def main(
     anndata="${anndata}",
     cells_geo_json="${cells_geo_json}",
     image="${image}",
-    pixel_size="${pixel_size}"
+    metadata="${metadata}",
+    calibration="${calibration ?: ''}",
+    coordinate_units="${coordinate_units}"
 ):
-    
-    # Read in the pixel size value from the pixel_size file
-    logger.info(f"Reading in {pixel_size}")
-    with open(pixel_size, "r") as f:
-        pixel_size = float(f.read().strip())
-    logger.info(f"pixel_size is {pixel_size}")
+
+    # Read in the channel names and pixel size of the image
+    logger.info(f"Reading in {metadata}")
+    with open(metadata, "r") as f:
+        metadata = json.load(f)
+
+    # The cell coordinates are either in microns (e.g. from QuPath)
+    # or in pixels (e.g. from cellpose)
+    if coordinate_units == "micron":
+        pixel_size = read_calibration(calibration, metadata)
+    elif coordinate_units == "pixel":
+        pixel_size = 1.0
+    else:
+        raise ValueError(f"Unrecognized coordinate units: {coordinate_units}")
+    logger.info(f"pixel_size is {pixel_size} ({coordinate_units} coordinates)")
 
     # Read in the AnnData object
     logger.info(f"Reading in {anndata}")
     table = read_table(anndata)
 
-    # Read in the cell geometry
+    # Read in the outlines of the cells and nuclei
     logger.info(f"Reading in {cells_geo_json}")
-    geo_json = json.load(gzip.open(cells_geo_json, "r"))
+    ids, geometries = read_geo_json(
+        cells_geo_json,
+        ["geometry", "nucleusGeometry"]
+    )
 
     # Parse the outlines of the cells and nuclei, and the centroids
-    masks = {
+    masks: Mapping[str, GeoDataFrame] = {
         kw: parse_geo_json(
-            geo_json,
-            val,
+            ids,
+            *geometries[val],
+            kw=val,
             pixel_size=pixel_size
         )
         for kw, val in [
             ("cell", "geometry"),
             ("nucleus", "nucleusGeometry")
         ]
-        if has_geometry(geo_json, val)
+        if val in geometries
     }
+    del geometries
 
     shapes = dict(
         centroids=make_spatial_points(
@@ -526,44 +1014,157 @@ def main(
         )
     )
 
-    # Read in the image, adding the annotated shapes
+    # The integer instance ID of each cell, keyed by the cell ID in the GeoJSON
+    instance_key = table.uns["spatialdata_attrs"]["instance_key"]
+    instance_ids = pd.Series(
+        table.obs[instance_key].values,
+        index=table.obs["${params.instance_key}"].astype(str).values
+    )
+
+    # Put the outlines in the same order as the table
+    masks: Mapping[str, np.ndarray] = {
+        mask_name: align_to_table(mask_geo, instance_ids)
+        for mask_name, mask_geo in masks.items()
+    }
+
+    # Index the bounding boxes of the outlines and the centroids
+    spatial_index: Mapping[str, PackedRTree] = {
+        f"{mask_name}_boundaries": PackedRTree(shapely.bounds(geometry))
+        for mask_name, geometry in masks.items()
+    }
+    spatial_index["centroids"] = PackedRTree(
+        np.tile(shapes["centroids"].geometry.get_coordinates().values, 2)
+    )
+    for key, tree in spatial_index.items():
+        logger.info(f"Indexed {len(tree.order):,} {key} ({len(tree.level_offsets) - 1} levels)")
+
+    # Optionally add simplified outlines at several levels of detail
+    # (e.g. cell_boundaries_lod0, cell_boundaries_lod1)
+    n_workers = int("${task.cpus}")
+    tolerances = parse_tolerances("${params.polygon_tolerances}")
+    if len(tolerances) > 0:
+        for mask_name, geometry in masks.items():
+            logger.info(f"Simplifying the {mask_name} outlines")
+            lod_shapes = make_lod_shapes(geometry, instance_ids, tolerances, n_workers)
+            for ix, lod_shape in enumerate(lod_shapes):
+                shapes[f"{mask_name}_boundaries_lod{ix}"] = lod_shape
+
+    # The chunks of the image and label pyramids are encoded with the same codec.
+    # The pyramid levels are written with a single dask compute, so they
+    # are read, downsampled, encoded and written in parallel by a thread pool.
+    compressor = make_compressor()
+    logger.info(f"Compressing chunks with {compressor}")
+    pyramid_params = dict(
+        compressor=compressor.get_config() if compressor is not None else None,
+        chunk_size="${params.zarr_chunk_size}",
+        chunk_bytes="${params.zarr_chunk_bytes}"
+    )
+
+    # The TIFF is only read in full to hash its contents when the hash is
+    # needed, to key the pyramid cache or the checkpoint
+    content_hash = None
+    if "${params.image_cache_dir}" != "false" or "${params.checkpoint_dir}" != "false":
+        content_hash = hash_file(image)
+
+    # The image pyramid can be reused from a previous run on the same image
+    cached_image = None
+    if "${params.image_cache_dir}" != "false":
+        cached_image = Path("${params.image_cache_dir}") / pyramid_key(metadata, content_hash, **pyramid_params)
+        if cached_image.exists():
+            logger.info(f"Using the cached image pyramid from {cached_image}")
+        else:
+            logger.info(f"No cached image pyramid found at {cached_image}")
+
+    # Optionally write the pyramids chunk by chunk to a checkpoint,
+    # which is resumed if a previous run with the same inputs was interrupted
+    checkpoint = None
+    if "${params.checkpoint_dir}" != "false":
+        checkpoint = ChunkCheckpoint(
+            Path("${params.checkpoint_dir}") / pyramid_key(
+                metadata,
+                content_hash,
+                anndata=hash_file(anndata),
+                cells_geo_json=hash_file(cells_geo_json),
+                **pyramid_params
+            ),
+            n_workers=n_workers,
+            compressor=compressor
+        )
+        logger.info(f"Writing the pyramids to the checkpoint {checkpoint.path}")
+        if cached_image is not None and cached_image.exists():
+            checkpoint.exclude.add("images/image")
+
+    # Read in the image, adding the annotated shapes, labels
     # and table to the SpatialData object
     logger.info("Reading in the image")
     sdata, channel_names = read_tif(
         image,
         table=table,
         shapes=shapes,
-        masks=masks
+        masks=masks,
+        instance_ids=instance_ids,
+        spatial_index=spatial_index,
+        metadata=metadata,
+        checkpoint=checkpoint
     )
 
-    # Save to Zarr
-    zarr_path = "spatialdata.zarr"
-    logger.info(f"Saving to {zarr_path}")
-    sdata.write(zarr_path, format=ShapesFormatV01())
-
-    # Fix the omero metadata for any images
-    logger.info(f"Fixing Zarr image metadata for {zarr_path}")
-    fix_zarr_image_metadata(zarr_path)
-
-    # Duplicate the {zarr_path}/tables/ folder to {zarr_path}/table/
-    logger.info("Duplicating the tables folder")
-    shutil.copytree(
-        zarr_path + "/tables",
-        zarr_path + "/table"
+    # Show the cell outlines if available, otherwise the nuclei
+    labels_key = next(
+        (
+            f"{kw}_labels"
+            for kw in ["cell", "nucleus"]
+            if kw in masks
+        ),
+        None
     )
 
-    # Zip up the spatialdata.zarr folder using shutil
-    logger.info("Zipping up the Zarr folder")
-    shutil.make_archive(
-        "spatialdata.zarr",
-        "zip",
-        root_dir=".",
-        base_dir="spatialdata.zarr"
-    )
+    # Show the coarsest outlines as polygons in the viewer
+    segmentations_key = next(
+        (
+            f"{kw}_boundaries_lod{len(tolerances) - 1}"
+            for kw in ["cell", "nucleus"]
+            if kw in masks
+        ),
+        None
+    ) if len(tolerances) > 0 else None
+
+    # Optionally compare codecs on a sample of the image chunks
+    if "${params.zarr_codec_benchmark}" == "true":
+        benchmark_codecs(sdata.images["image"]["scale0"]["image"].data)
+
+    # The image pyramid is reused from the cache, rather than written again
+    if cached_image is not None and cached_image.exists():
+        del sdata.images["image"]
 
-    # Remove the spatialdata.zarr folder
-    logger.info("Removing the Zarr folder")
-    shutil.rmtree("spatialdata.zarr")
+    # Save to Zarr
+    zarr_path = "spatialdata.zarr"
+    logger.info(f"Saving to {zarr_path} (threads={n_workers})")
+    start = time.perf_counter()
+    with dask.config.set(scheduler="threads", num_workers=n_workers):
+        write_spatialdata(sdata, zarr_path, compressor)
+    logger.info(f"Saved {zarr_path} in {time.perf_counter() - start:.1f}s")
+
+    image_group = Path(zarr_path) / "images" / "image"
+    if cached_image is not None and cached_image.exists():
+        zarr.open_group(zarr_path, mode="r+").require_group("images")
+        copy_zarr_group(cached_image, image_group)
+
+    # Compute the contrast window of each channel from the coarsest level
+    # of the pyramid, so that the viewer can open with a sensible contrast
+    channel_windows = compute_channel_windows(zarr_path, "image")
+
+    # Fix the omero metadata for the images,
+    # then consolidate the metadata of the whole store
+    write_omero_defaults(zarr_path, dict(image=channel_windows))
+
+    # Save the image pyramid (with its omero metadata) for later runs
+    if cached_image is not None and not cached_image.exists():
+        save_to_cache(image_group, cached_image)
+
+    # Save the spatial index of each set of shapes (e.g. spatial_index/centroids),
+    # where the items are the rows of the table
+    write_spatial_index(zarr_path, spatial_index)
+    sdata.write_consolidated_metadata()
 
     # Save the spatialdata kwargs to JSON
     logger.info("Saving spatialdata kwargs to JSON")
@@ -575,7 +1176,12 @@ def main(
                 obs_set_paths=["obs/leiden"],
                 init_gene=sdata.table.var_names[0],
                 channel_names=channel_names,
-                mask_channels=["cell", "nucleus"],
+                channel_windows=[
+                    [window["start"], window["end"]]
+                    for window in channel_windows
+                ],
+                labels_key=labels_key,
+                segmentations_key=segmentations_key,
                 image_key="image",
                 obs_type="cell",
                 feature_type="marker",
@@ -586,32 +1192,347 @@ def main(
             indent=4
         )
 
+    # Keep a copy of the kwargs in the store, so that they can be
+    # regenerated when only the table is updated (update_table.py)
+    shutil.copy("spatialdata.kwargs.json", Path(zarr_path) / "spatialdata.kwargs.json")
+
+    # Move the Zarr folder into an uncompressed zip archive,
+    # mirroring the {zarr_path}/tables/ folder to {zarr_path}/table/
+    logger.info(f"Zipping up {zarr_path}")
+    write_zarr_zip(zarr_path, zarr_path + ".zip")
+
+    # The checkpoint is no longer needed once the store is complete
+    if checkpoint is not None:
+        logger.info(f"Removing the checkpoint {checkpoint.path}")
+        shutil.rmtree(checkpoint.path)
+
+
+def read_calibration(calibration: str, metadata: dict) -> float:
+    """
+    Read the pixel size (µm) which was used to compute the coordinates of the
+    cells in microns, from the calibration saved by QuPath if given,
+    otherwise from the TIFF metadata.
+    The TIFF must then have a pixel size, since the cells would otherwise
+    be silently misplaced relative to the image and labels.
+    """
+
+    if calibration == "":
+        if metadata["pixel_size_source"] == "default":
+            raise ValueError(
+                "The cell coordinates are in microns, but the pixel size of the image is unknown"
+            )
+        logger.info(f"Pixel size from the TIFF metadata: {metadata['pixel_size']} µm")
+        return metadata["pixel_size"]
+
+    with open(calibration) as handle:
+        calibration = json.load(handle)
+    pixel_size = float(calibration["pixel_size"])
+    logger.info(f"Pixel size used by QuPath: {pixel_size} {calibration['unit']}")
+
+    if not calibration["has_microns"]:
+        logger.warning("QuPath found no pixel size for the image, so the cell coordinates are in pixels")
+    elif metadata["pixel_size_source"] == "default":
+        logger.warning("The pixel size was only found by QuPath, not in the TIFF metadata")
+    elif not np.isclose(pixel_size, metadata["pixel_size"], rtol=1e-3):
+        logger.warning(
+            f"The pixel size used by QuPath ({pixel_size} µm) differs from "
+            f"the TIFF metadata ({metadata['pixel_size']} µm), using the former"
+        )
+    return pixel_size
+
+
+def pyramid_key(metadata: dict, content_hash: str, **kwargs) -> str:
+    """
+    Key for the image pyramid in the cache (or for the checkpoint of a run),
+    from the hash of the contents of the TIFF and the parameters
+    (and inputs) used to build the pyramids.
+    """
+
+    params = dict(
+        content_hash=content_hash,
+        channel_names=metadata["channel_names"],
+        spatialdata_version=spatialdata.__version__,
+        **kwargs
+    )
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def hash_file(fp: str, block_size=1 << 23) -> str:
+    """Compute the SHA-256 hash of the contents of a file."""
+    logger.info(f"Hashing {fp}")
+    sha = hashlib.sha256()
+    with open(fp, "rb") as handle:
+        for block in iter(lambda: handle.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def copy_zarr_group(src: Path, dest: Path):
+    """Copy a Zarr group, using hard links for the files where possible."""
+
+    def _link_or_copy(src_file, dest_file):
+        try:
+            os.link(src_file, dest_file)
+        except OSError:
+            shutil.copy2(src_file, dest_file)
+
+    shutil.copytree(src, dest, copy_function=_link_or_copy)
+
+
+def save_to_cache(src: Path, dest: Path):
+    """
+    Save a Zarr group to the cache, moving it into place only once
+    complete so that partial copies are never used.
+    """
+
+    logger.info(f"Saving the image pyramid to {dest}")
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f"{dest.name}.tmp-{os.getpid()}")
+    copy_zarr_group(src, tmp)
+    try:
+        tmp.rename(dest)
+    except OSError:
+        # Another run saved the same pyramid first
+        shutil.rmtree(tmp)
+
+
+def parse_tolerances(tolerances: str) -> List[float]:
+    """Parse a comma-separated list of tolerances (or "false"), from finest to coarsest."""
+    if tolerances in ["false", ""]:
+        return []
+    return sorted(float(tol) for tol in tolerances.split(","))
+
+
+def make_compressor(
+    cname="${params.zarr_compressor}",
+    clevel="${params.zarr_compression_level}",
+    shuffle="${params.zarr_shuffle}"
+) -> Union[Blosc, None]:
+    """
+    Build the Blosc compressor used for the chunks of the Zarr store
+    (e.g. zstd or lz4), or None if cname is "none".
+    """
+
+    if cname == "none":
+        return None
+
+    shuffle_modes = dict(
+        noshuffle=Blosc.NOSHUFFLE,
+        shuffle=Blosc.SHUFFLE,
+        bitshuffle=Blosc.BITSHUFFLE
+    )
+    if shuffle not in shuffle_modes:
+        raise ValueError(f"Unrecognized shuffle mode: {shuffle} (options: {', '.join(shuffle_modes)})")
+
+    return Blosc(cname=cname, clevel=int(clevel), shuffle=shuffle_modes[shuffle])
+
+
+def benchmark_codecs(
+    image: da.Array,
+    n_chunks=16,
+    cnames=["zstd", "lz4", "lz4hc", "blosclz", "zlib"],
+    clevels=[1, 5, 9],
+    shuffles=["shuffle", "bitshuffle"],
+    output_fp="codec_benchmark.csv"
+):
+    """
+    Compare the write throughput, read throughput and compression ratio of
+    Blosc codecs on a sample of chunks spread evenly across the image.
+    The throughput includes writing the encoded chunks to (and reading them
+    from) a Zarr directory store in the working directory.
+    """
+
+    # Pick chunks spread evenly across the image
+    blocks = list(np.ndindex(*image.numblocks))
+    ixs = np.linspace(0, len(blocks) - 1, min(n_chunks, len(blocks))).astype(int)
+    logger.info(f"Benchmarking codecs on {len(ixs):,} of {len(blocks):,} chunks")
+    chunks = [
+        np.ascontiguousarray(image.blocks[blocks[ix]].compute())
+        for ix in ixs
+    ]
+    n_bytes = sum(chunk.nbytes for chunk in chunks)
+
+    results = []
+    for cname in cnames:
+        for clevel in clevels:
+            for shuffle in shuffles:
+                codec = make_compressor(cname, clevel, shuffle)
+
+                with tempfile.TemporaryDirectory(dir=".") as tmp:
+                    store = zarr.DirectoryStore(tmp)
+
+                    start = time.perf_counter()
+                    for ix, chunk in enumerate(chunks):
+                        store[str(ix)] = codec.encode(chunk)
+                    write_time = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    for ix in range(len(chunks)):
+                        codec.decode(store[str(ix)])
+                    read_time = time.perf_counter() - start
 
-def fix_zarr_image_metadata(zarr_path: str):
+                    n_encoded = sum(len(store[str(ix)]) for ix in range(len(chunks)))
+
+                results.append(dict(
+                    cname=cname,
+                    clevel=clevel,
+                    shuffle=shuffle,
+                    ratio=n_bytes / n_encoded,
+                    write_mb_s=n_bytes / 1e6 / write_time,
+                    read_mb_s=n_bytes / 1e6 / read_time
+                ))
+
+    results = pd.DataFrame(results).sort_values("ratio", ascending=False)
+    logger.info(f"Codec benchmark:\\n{results.to_string(index=False, float_format='%.2f')}")
+    results.to_csv(output_fp, index=False)
+
+
+@contextmanager
+def default_compressor(compressor: Union[Blosc, None]):
+    """
+    Set the codec of the Zarr arrays created without an explicit compressor,
+    restoring the previous default on exit.
+    """
+
+    previous = zarr.storage.default_compressor
+    zarr.storage.default_compressor = compressor
+    try:
+        yield
+    finally:
+        zarr.storage.default_compressor = previous
+
+
+def write_spatialdata(sdata: spatialdata.SpatialData, zarr_path: str, compressor: Union[Blosc, None]):
+    """
+    Write a SpatialData object to Zarr, encoding the chunks of the images and
+    labels with `compressor`, and the other elements with the zarr defaults.
+
+    spatialdata 0.2 replaces the storage options of each pyramid level with
+    its chunks, so ome-zarr encodes them with zarr's default compressor.
+    The rasters are therefore written separately, after the other elements,
+    with the default set to `compressor` only while they are written.
+    """
+
+    images, labels = dict(sdata.images), dict(sdata.labels)
+    for name in images:
+        del sdata.images[name]
+    for name in labels:
+        del sdata.labels[name]
+
+    sdata.write(zarr_path, format=ShapesFormatV01(), consolidate_metadata=False)
+
+    root = zarr.open_group(zarr_path, mode="r+")
+    with default_compressor(compressor):
+        for name, image in images.items():
+            write_image(image, root.require_group("images"), name)
+            sdata.images[name] = image
+        for name, label in labels.items():
+            write_labels(label, root, name)
+            sdata.labels[name] = label
+
+
+def write_zarr_zip(
+    zarr_path: str,
+    zip_path: str,
+    mirror={"tables": "table"}
+):
     """
-    Given a zarr store, fill out any missing fields
-    in the omero field of the image attributes.
+    Move a zarr store into an uncompressed (stored) zip archive in a
+    single sequential pass, since the chunks are already compressed.
+
+    - The files in each of the `mirror` groups are added a second time
+      under the mirrored name, for readers of the older layout with a single
+      `table` element. Zip entries cannot share their data (each local header
+      carries its own file name), so the mirror is stored twice in the archive,
+      but it is no longer copied on disk first
+    - Each file is removed once it has been added to the archive
     """
 
-    # Iterate over every .zattr or zmetadata file
-    for pattern in ["zmetadata", ".zattrs"]:
-        for file in Path(zarr_path).rglob(pattern):
+    root = Path(zarr_path)
+    n_files = 0
+    with ZipFile(zip_path, "w", compression=ZIP_STORED, allowZip64=True) as zf:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file = Path(dirpath) / filename
+                parts = file.relative_to(root).parts
 
-            # Open the object
-            obj = json.load(file.open())
+                # Paths within the archive include the name of the store
+                names = [Path(root.name, *parts).as_posix()]
+                if parts[0] in mirror:
+                    names.append(Path(root.name, mirror[parts[0]], *parts[1:]).as_posix())
 
-            # Recurse into the object, make updates, and
-            # return a bool indicating if the object was changed
-            if _update_omero_attr(obj):
+                for name in names:
+                    zf.write(file, name)
 
-                # Write out the updated object
-                with file.open("w") as handle:
-                    json.dump(obj, handle, indent=4)
+                file.unlink()
+                n_files += 1
 
+    logger.info(f"Added {n_files:,} files to {zip_path}")
+    shutil.rmtree(zarr_path)
 
-def _update_omero_attr(obj):
+
+def compute_channel_windows(
+    zarr_path: str,
+    image_key: str,
+    percentiles=[1, 99]
+) -> List[dict]:
     """
-    If the omero attribute is present, fill in any missing fields.
+    Compute the contrast window of each channel of an image from the
+    percentiles (e.g. p1-p99) of the coarsest level of its pyramid,
+    which is only a few hundred pixels across.
+    The range of the window is the range of the data type for integers,
+    or the range of the values otherwise.
+    """
+
+    group = zarr.open_group(zarr_path, mode="r")["images"][image_key]
+    coarsest = group.attrs["multiscales"][0]["datasets"][-1]["path"]
+    level = group[coarsest][:]
+    logger.info(f"Computing channel windows from images/{image_key}/{coarsest} {level.shape}")
+
+    windows = []
+    for channel in level.reshape(level.shape[0], -1):
+        start, end = np.percentile(channel, percentiles)
+
+        # Sparse channels may have the same value at both percentiles
+        if end <= start:
+            end = max(channel.max(), start + 1)
+
+        if np.issubdtype(level.dtype, np.integer):
+            vmin, vmax = np.iinfo(level.dtype).min, np.iinfo(level.dtype).max
+        else:
+            vmin, vmax = channel.min(), channel.max()
+
+        windows.append(dict(
+            start=float(start),
+            end=float(end),
+            min=float(vmin),
+            max=float(vmax)
+        ))
+        logger.info(f"Channel window: {windows[-1]}")
+
+    return windows
+
+
+def write_spatial_index(zarr_path: str, spatial_index: Mapping[str, PackedRTree]):
+    """Save each spatial index in the spatial_index/ group of the Zarr store."""
+
+    root = zarr.open_group(zarr_path, mode="r+").require_group("spatial_index")
+    for key, tree in spatial_index.items():
+        logger.info(f"Saving spatial_index/{key}")
+        tree.to_zarr(
+            root.require_group(key),
+            items="tables/table",
+            coordinate_system="global"
+        )
+
+
+def write_omero_defaults(zarr_path: str, channel_windows: Mapping[str, List[dict]]):
+    """
+    Fill in the display settings (color, window, rdefs) of the omero
+    metadata of each image, where spatialdata only writes the channel labels.
+    The windows of the channels are set from channel_windows (keyed by image).
+    Only the attributes of the image groups are read and rewritten.
     """
 
     _default_channel = {
@@ -628,39 +1549,29 @@ def _update_omero_attr(obj):
         "name": "global"
     }
 
-    was_modified = False
-
-    if isinstance(obj, dict) and "omero" in obj:
-        logger.info("Updating omero attribute")
+    root = zarr.open_group(zarr_path, mode="r+")
+    for image_key, windows in channel_windows.items():
+        group = root["images"][image_key]
+        attrs = group.attrs.asdict()
 
-        if "channels" in obj["omero"]:
-            for channel in obj["omero"]["channels"]:
+        # The omero field is written at the top level of the attributes,
+        # and again in the metadata of each multiscale
+        omeros = [attrs.get("omero")] + [
+            multiscale.get("metadata", {}).get("omero")
+            for multiscale in attrs.get("multiscales", [])
+        ]
+        for omero in omeros:
+            if omero is None:
+                continue
+            for channel, window in zip(omero.get("channels", []), windows):
+                channel["window"] = window
                 for kw, val in _default_channel.items():
-                    if kw not in channel:
-                        channel[kw] = val
-                        was_modified = True
-
-            if "rdefs" not in obj["omero"]:
-                obj["omero"]["rdefs"] = _default_rdefs
-                was_modified = True
-            else:
-                for kw, val in _default_rdefs.items():
-                    if kw not in obj["omero"]["rdefs"]:
-                        obj["omero"]["rdefs"][kw] = val
-                        was_modified = True
-
-        logger.info(obj["omero"])
-
-    if isinstance(obj, dict):
-        for val in obj.values():
-            if _update_omero_attr(val):
-                was_modified = True
-    elif isinstance(obj, list):
-        for val in obj:
-            if _update_omero_attr(val):
-                was_modified = True
-
-    return was_modified
+                    channel.setdefault(kw, deepcopy(val))
+            omero["rdefs"] = {**_default_rdefs, **omero.get("rdefs", {})}
+
+        logger.info(f"Updating omero attribute of images/{image_key}")
+        logger.info(attrs.get("omero"))
+        group.attrs.put(attrs)
 
 
 main()
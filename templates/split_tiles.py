@@ -0,0 +1,100 @@
+#!/usr/local/bin/python3
+
+from pathlib import Path
+from tifffile import TiffFile, imwrite
+from typing import List
+import json
+import logging
+import zarr
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def main(
+    image="${image}",
+    tile_size="${params.tile_size}",
+    overlap="${params.tile_overlap}",
+    output_dir="tiles",
+    layout_fp="tiles.json"
+):
+    """
+    Split a TIF file into overlapping tiles, which are segmented
+    as separate tasks and then stitched together (stitch_tiles.py).
+    """
+
+    # If there are backslashes in the path, remove them and inform the user
+    if "\\\\" in image:
+        logger.info(f"Removing backslashes from file path ({image})")
+        image = image.replace("\\\\", "")
+        logger.info(f"New file path: {image}")
+
+    tile_size = int(tile_size)
+    overlap = int(overlap)
+
+    logger.info(f"Reading {image}")
+    with TiffFile(image) as tif:
+        axes = tif.series[0].axes
+        pixels = zarr.open(tif.series[0].aszarr(), mode="r")
+        logger.info(f"Image shape: {pixels.shape} ({axes})")
+
+        if "Y" not in axes or "X" not in axes:
+            raise ValueError(f"Expected an image with Y and X axes, found {axes}")
+        yax, xax = axes.index("Y"), axes.index("X")
+        height, width = pixels.shape[yax], pixels.shape[xax]
+
+        # Each tile is made up of a core, which is owned by the tile when the
+        # masks are stitched together, and a margin of overlap on each side
+        Path(output_dir).mkdir(exist_ok=True)
+        tiles = []
+        for y0, y1 in split_axis(height, tile_size):
+            for x0, x1 in split_axis(width, tile_size):
+                tile = dict(
+                    name=f"tile_{y0:06d}_{x0:06d}",
+                    core=[y0, x0, y1, x1],
+                    bounds=[
+                        max(y0 - overlap, 0),
+                        max(x0 - overlap, 0),
+                        min(y1 + overlap, height),
+                        min(x1 + overlap, width)
+                    ]
+                )
+
+                ty0, tx0, ty1, tx1 = tile["bounds"]
+                region = [slice(None)] * len(axes)
+                region[yax] = slice(ty0, ty1)
+                region[xax] = slice(tx0, tx1)
+
+                logger.info(f"Writing {tile['name']} (bounds: {tile['bounds']})")
+                imwrite(
+                    Path(output_dir) / f"{tile['name']}.tiff",
+                    pixels[tuple(region)],
+                    photometric="minisblack",
+                    compression="zlib"
+                )
+                tiles.append(tile)
+
+    logger.info(f"Split the image into {len(tiles):,} tiles")
+    with open(layout_fp, "w") as f:
+        json.dump(
+            dict(
+                shape=[height, width],
+                tile_size=tile_size,
+                overlap=overlap,
+                tiles=tiles
+            ),
+            f,
+            indent=4
+        )
+
+
+def split_axis(size: int, tile_size: int) -> List[List[int]]:
+    """Split an axis into intervals of tile_size (the last may be shorter)."""
+    return [
+        [start, min(start + tile_size, size)]
+        for start in range(0, size, tile_size)
+    ]
+
+
+main()
@@ -0,0 +1,110 @@
+#!/usr/local/bin/python3
+
+from pathlib import Path
+from typing import Optional
+from urllib.request import urlretrieve
+import hashlib
+import logging
+import os
+import re
+import shutil
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def main(
+    name="${params.pretrained_model}",
+    cache_dir="${params.model_cache}",
+    expected="${params.pretrained_model_sha256}",
+    url="https://www.cellpose.org/models/${params.pretrained_model}"
+):
+    """
+    Resolve a pretrained cellpose model from the local cache, where each model
+    is saved as model_cache/<name>/<SHA-256 of the model>. The cached model is
+    verified against its checksum, and only downloaded if it is missing.
+    """
+
+    model_dir = Path(cache_dir) / name
+    expected = None if expected == "false" else expected.lower()
+
+    cached = find_cached(model_dir, expected)
+    if cached is None:
+        cached = download(url, model_dir, expected)
+
+    # Copy the model into the work directory, so that it can be staged
+    # into the cellpose container without mounting the cache
+    logger.info(f"Copying {cached} to {name}")
+    shutil.copyfile(cached, name)
+
+
+def find_cached(model_dir: Path, expected: Optional[str]) -> Optional[Path]:
+    """
+    Find a cached copy of the model whose contents match its checksum,
+    either the one pinned with pretrained_model_sha256 or the most recent.
+    """
+
+    if expected is not None:
+        candidates = [model_dir / expected]
+    elif model_dir.exists():
+        candidates = sorted(
+            [
+                fp for fp in model_dir.iterdir()
+                if re.fullmatch("[0-9a-f]{64}", fp.name)
+            ],
+            key=lambda fp: fp.stat().st_mtime,
+            reverse=True
+        )
+    else:
+        candidates = []
+
+    for fp in candidates:
+        if not fp.exists():
+            continue
+        if hash_file(fp) == fp.name:
+            logger.info(f"Using the cached model {fp}")
+            return fp
+        logger.warning(f"The checksum of {fp} does not match, ignoring it")
+
+    logger.info(f"No cached model found in {model_dir}")
+    return None
+
+
+def download(url: str, model_dir: Path, expected: Optional[str]) -> Path:
+    """
+    Download the model into the cache, moving it into place only once
+    its checksum is known so that partial downloads are never used.
+    """
+
+    model_dir.mkdir(parents=True, exist_ok=True)
+    tmp = model_dir / f".download.tmp-{os.getpid()}"
+    logger.info(f"Downloading {url}")
+    try:
+        urlretrieve(url, tmp)
+    except Exception:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    checksum = hash_file(tmp)
+    if expected is not None and checksum != expected:
+        tmp.unlink()
+        raise ValueError(f"The checksum of {url} ({checksum}) does not match pretrained_model_sha256 ({expected})")
+
+    dest = model_dir / checksum
+    logger.info(f"Saving the model to {dest}")
+    os.replace(tmp, dest)
+    return dest
+
+
+def hash_file(fp: Path, block_size=1 << 23) -> str:
+    """Compute the SHA-256 hash of the contents of a file (as in tiff_metadata.py)."""
+    logger.info(f"Hashing {fp}")
+    sha = hashlib.sha256()
+    with open(fp, "rb") as handle:
+        for block in iter(lambda: handle.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+main()
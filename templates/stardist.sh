@@ -19,13 +19,16 @@ echo | tee -a qupath.log.txt
 
 mkdir qupath_project
 
+# When segmenting one tile of the image, prefix the outputs with the tile name
+prefix="${tile.bounds ? tile.name + '.' : ''}"
+
 QuPath script \
     "${script}" \
     --args \$PWD/$seg_model \
-    --args \$PWD/measurements.csv \
+    --args \$PWD/\${prefix}measurements.csv \
     --args \$PWD/qupath_project \
     --args \$PWD/input.tiff \
-    --args \$PWD/cells.geo.json \
+    --args \$PWD/\${prefix}cells.geo.json \
     --args ${params.threshold} \
     --args ${params.channels} \
     --args ${params.cellExpansion} \
@@ -33,7 +36,9 @@ QuPath script \
     --args ${params.minPercentileNormalization} \
     --args ${params.maxPercentileNormalization} \
     --args ${task.cpus} \
+    --args ${tile.bounds ? tile.bounds.join(",") : "full"} \
+    --args \$PWD/\${prefix}pixel_calibration.json \
     | tee -a qupath.log.txt
 
-gzip measurements.csv
-gzip cells.geo.json
+gzip \${prefix}measurements.csv
+gzip \${prefix}cells.geo.json
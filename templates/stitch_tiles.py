@@ -0,0 +1,207 @@
+#!/usr/local/bin/python3
+
+from scipy import ndimage
+from tifffile import imread, imwrite
+from typing import Iterator, List, Tuple
+import json
+import logging
+import numpy as np
+import os
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def main(
+    layout="${layout}",
+    iou_threshold="${params.tile_iou_threshold}",
+    output_fp="stitched_labels.tiff",
+    tile_size=512
+):
+    """
+    Stitch the masks found by cellpose in each of the overlapping tiles
+    (split_tiles.py) into a single label image for the whole slide,
+    written as a compressed, tiled TIFF (as by write_labels.py).
+
+    The label image of the slide is held in a memory-mapped file on disk
+    (4 bytes per pixel) rather than in memory, and written out tile by tile.
+    """
+
+    with open(layout) as f:
+        layout = json.load(f)
+    iou_threshold = float(iou_threshold)
+
+    height, width = layout["shape"]
+    logger.info(f"Stitching {len(layout['tiles']):,} tiles into a {height} x {width} label image")
+    masks_fp = output_fp.replace(".tiff", ".npy")
+    masks = np.lib.format.open_memmap(masks_fp, mode="w+", dtype="uint32", shape=(height, width))
+
+    # Number of pixels assigned to each cell (indexed by the global ID)
+    areas = [0]
+
+    # Cells are taken from the core of each tile, extended by half of the overlap
+    # so that cells on the edge of a core are not missed when each tile finds
+    # a slightly different centroid
+    margin = layout["overlap"] / 2
+
+    totals = dict(owned=0, duplicate=0, cut=0)
+    for tile in layout["tiles"]:
+        fp = f"{tile['name']}_labels.tiff"
+        logger.info(f"Loading {fp}")
+        tile_masks = imread(fp)
+
+        counts = stitch_tile(masks, areas, tile_masks, tile, margin, iou_threshold)
+        logger.info(
+            f"{tile['name']}: added {counts['owned'] - counts['duplicate']:,} cells "
+            f"({counts['duplicate']:,} duplicates)"
+        )
+        for kw, val in counts.items():
+            totals[kw] += val
+
+    logger.info(f"Found {len(areas) - 1:,} cells ({totals['duplicate']:,} duplicates removed)")
+    if totals["cut"] > 0:
+        logger.warning(
+            f"{totals['cut']:,} cells were cut by the edge of their tile, "
+            "tile_overlap should be larger than the diameter of the cells"
+        )
+
+    logger.info(f"Saving {output_fp}")
+    imwrite(
+        output_fp,
+        iter_tiles(masks, tile_size),
+        shape=masks.shape,
+        dtype=masks.dtype,
+        photometric="minisblack",
+        tile=(tile_size, tile_size),
+        compression="zlib"
+    )
+    with open(output_fp.replace(".tiff", ".json"), "w") as f:
+        json.dump(
+            dict(
+                labels=output_fp,
+                shape=list(masks.shape),
+                dtype=str(masks.dtype),
+                n_cells=len(areas) - 1,
+                max_label=len(areas) - 1,
+                tile_size=tile_size,
+                compression="zlib",
+                tiles=len(layout["tiles"]),
+                duplicates=totals["duplicate"]
+            ),
+            f,
+            indent=4
+        )
+
+    # Remove the memory-mapped label image
+    del masks
+    os.remove(masks_fp)
+
+
+def stitch_tile(
+    masks: np.ndarray,
+    areas: List[int],
+    tile_masks: np.ndarray,
+    tile: dict,
+    margin: float,
+    iou_threshold: float
+) -> dict:
+    """
+    Add the cells of a tile to the global label image (in place).
+
+    Cells are taken from a tile if their centroid is within margin of its core,
+    so that most of the copies of a cell found in the overlap of neighboring
+    tiles are skipped. A cell which overlaps one already added with an IoU of
+    at least iou_threshold (or which is mostly covered by cells already added)
+    is taken to be a duplicate. Otherwise, cells only take the pixels which
+    are not yet assigned.
+    """
+
+    ty0, tx0, ty1, tx1 = tile["bounds"]
+    cy0, cx0, cy1, cx1 = tile["core"]
+    if tile_masks.ndim != 2:
+        raise ValueError(f"Tiled segmentation only supports 2D masks, found {tile_masks.shape}")
+    if tile_masks.shape != (ty1 - ty0, tx1 - tx0):
+        raise ValueError(f"Expected masks of shape {(ty1 - ty0, tx1 - tx0)} for {tile['name']}")
+
+    labels, cy, cx = find_centroids(tile_masks)
+    owned = (
+        (cy + ty0 >= cy0 - margin) & (cy + ty0 < cy1 + margin) &
+        (cx + tx0 >= cx0 - margin) & (cx + tx0 < cx1 + margin)
+    )
+    counts = dict(
+        owned=int(owned.sum()),
+        duplicate=0,
+        cut=int(np.isin(labels[owned], cut_labels(tile_masks, tile, masks.shape)).sum())
+    )
+
+    objects = ndimage.find_objects(tile_masks)
+    for label in labels[owned]:
+        bbox = objects[label - 1]
+        cell = tile_masks[bbox] == label
+        region = masks[
+            bbox[0].start + ty0:bbox[0].stop + ty0,
+            bbox[1].start + tx0:bbox[1].stop + tx0
+        ]
+
+        # Skip cells which were already added from another tile,
+        # or which are mostly covered by cells already added
+        free = cell & (region == 0)
+        existing = region[cell]
+        existing = existing[existing > 0]
+        if len(existing) > 0:
+            other_labels, overlaps = np.unique(existing, return_counts=True)
+            other, overlap = other_labels[overlaps.argmax()], overlaps.max()
+            iou = overlap / (cell.sum() + areas[other] - overlap)
+            if iou >= iou_threshold or free.sum() < cell.sum() / 2:
+                counts["duplicate"] += 1
+                continue
+
+        # Relabel with the next global ID
+        region[free] = len(areas)
+        areas.append(int(free.sum()))
+
+    return counts
+
+
+def iter_tiles(masks: np.ndarray, tile_size: int) -> Iterator[np.ndarray]:
+    """Yield the tiles of a label image in row-major order, padding those on the edges."""
+    height, width = masks.shape
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile = np.zeros((tile_size, tile_size), dtype=masks.dtype)
+            block = masks[y:y + tile_size, x:x + tile_size]
+            tile[:block.shape[0], :block.shape[1]] = block
+            yield tile
+
+
+def find_centroids(tile_masks: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the label and the (y, x) centroid of each cell in a tile."""
+    ys, xs = np.nonzero(tile_masks)
+    ids = tile_masks[ys, xs]
+    n_pixels = np.bincount(ids)
+    labels = np.flatnonzero(n_pixels[1:]) + 1
+    cy = np.bincount(ids, weights=ys)[labels] / n_pixels[labels]
+    cx = np.bincount(ids, weights=xs)[labels] / n_pixels[labels]
+    return labels, cy, cx
+
+
+def cut_labels(tile_masks: np.ndarray, tile: dict, shape: Tuple[int, int]) -> np.ndarray:
+    """Labels of the cells which touch an edge of the tile (other than the edge of the image)."""
+    ty0, tx0, ty1, tx1 = tile["bounds"]
+    edges = [
+        edge
+        for edge, inside in [
+            (tile_masks[0, :], ty0 > 0),
+            (tile_masks[:, 0], tx0 > 0),
+            (tile_masks[-1, :], ty1 < shape[0]),
+            (tile_masks[:, -1], tx1 < shape[1])
+        ]
+        if inside
+    ]
+    if len(edges) == 0:
+        return np.array([], dtype=tile_masks.dtype)
+    return np.unique(np.concatenate(edges))
+
+
+main()
@@ -0,0 +1,276 @@
+#!/usr/local/bin/python3
+
+from tifffile import TiffFile, TiffPage, RESUNIT
+from typing import List, Union
+from xml.etree import ElementTree
+import json
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+OME_NS = "{http://www.openmicroscopy.org/Schemas/OME/2016-06}"
+
+# Size of each unit in microns
+UNIT_MICRONS = {
+    "nm": 1e-3,
+    "µm": 1.0,
+    "um": 1.0,
+    "micron": 1.0,
+    "mm": 1e3,
+    "cm": 1e4,
+    "m": 1e6
+}
+
+
+def main(image="${image}", output_fp="tiff_metadata.json"):
+    """
+    Read all of the metadata needed by the pipeline from a TIF file,
+    opening the file only once.
+    """
+
+    # If there are backslashes in the path, remove them and inform the user
+    if "\\\\" in image:
+        logger.info(f"Removing backslashes from file path ({image})")
+        image = image.replace("\\\\", "")
+        logger.info(f"New file path: {image}")
+
+    logger.info(f"Reading metadata from {image}")
+    with TiffFile(image) as tif:
+        series = tif.series[0]
+        pages = series.pages
+        ome_root = _parse_ome_xml(tif.ome_metadata)
+
+        shape = list(series.shape)
+        n_channels = count_channels(shape)
+        logger.info(f"Image shape: {shape} ({series.axes}), dtype: {series.dtype}")
+
+        channel_names = read_tif_channel_names(pages, ome_root, n_channels)
+        pixel_size, pixel_size_source = read_pixel_size(pages[0], ome_root, tif.imagej_metadata)
+
+        levels = [
+            dict(
+                shape=list(level.shape),
+                tile_shape=read_tile_shape(level.pages[0])
+            )
+            for level in series.levels
+        ]
+        for ix, level in enumerate(levels):
+            logger.info(f"Level {ix}: {level['shape']} (tiles: {level['tile_shape']})")
+
+        metadata = dict(
+            file=image,
+            shape=shape,
+            axes=series.axes,
+            dtype=str(series.dtype),
+            n_channels=n_channels,
+            channel_names=channel_names,
+            pixel_size=pixel_size,
+            pixel_size_unit="µm",
+            pixel_size_source=pixel_size_source,
+            tile_shape=levels[0]["tile_shape"],
+            levels=levels
+        )
+
+    logger.info(f"Writing {output_fp}")
+    with open(output_fp, "w") as f:
+        json.dump(metadata, f, indent=4, ensure_ascii=False)
+
+
+def count_channels(shape: List[int]) -> int:
+    """
+    Count the channels of an image, taking the color axis to be the shortest
+    one after dropping any extra dimensions of length 1 (as in spatialdata.py).
+    """
+
+    if len(shape) > 3:
+        shape = [n for n in shape if n != 1]
+    if len(shape) == 2:
+        return 1
+    return min(shape)
+
+
+def read_tile_shape(page: TiffPage) -> Union[None, List[int]]:
+    """Return the (height, width) of the tiles of a page, or None if it is not tiled."""
+    if not page.is_tiled:
+        return None
+    return [page.tilelength, page.tilewidth]
+
+
+def read_pixel_size(
+    page: TiffPage,
+    ome_root: Union[None, ElementTree.Element],
+    imagej_metadata: Union[None, dict] = None
+):
+    """
+    Read the width of each pixel in microns, from the OME-XML metadata if present,
+    then from the ImageJ metadata (unit) with the resolution tags of the first page,
+    or otherwise from the resolution tags in centimeters.
+    Resolutions in inches are ignored, as many writers set a default of 72 dpi.
+    Defaults to 1.0 if the image is not calibrated.
+    """
+
+    # Try the OME-XML metadata
+    if ome_root is not None:
+        pixels = ome_root.find(f".//{OME_NS}Pixels")
+        if pixels is not None and pixels.attrib.get("PhysicalSizeX") is not None:
+            unit = pixels.attrib.get("PhysicalSizeXUnit", "µm")
+            if unit in UNIT_MICRONS:
+                pixel_size = float(pixels.attrib["PhysicalSizeX"]) * UNIT_MICRONS[unit]
+                logger.info(f"Pixel size from OME-XML: {pixel_size} µm")
+                return pixel_size, "ome"
+            logger.info(f"Unrecognized unit for PhysicalSizeX: {unit}")
+
+    # Try the resolution tags (pixels per unit)
+    tag = page.tags.get("XResolution")
+    numerator, denominator = tag.value if tag is not None else (0, 0)
+    if numerator > 0 and denominator > 0:
+
+        # ImageJ gives the unit of the resolution in its own metadata
+        unit = (imagej_metadata or {}).get("unit")
+        if unit in UNIT_MICRONS:
+            pixel_size = UNIT_MICRONS[unit] * denominator / numerator
+            logger.info(f"Pixel size from the ImageJ metadata: {pixel_size} µm")
+            return pixel_size, "imagej"
+
+        if page.resolutionunit == RESUNIT.CENTIMETER:
+            pixel_size = 10000.0 * denominator / numerator
+            logger.info(f"Pixel size from the resolution tags: {pixel_size} µm")
+            return pixel_size, "resolution"
+
+        logger.warning(f"Ignoring the resolution tags with unit {page.resolutionunit.name}")
+
+    logger.warning("No pixel size found, using 1.0")
+    return 1.0, "default"
+
+
+def read_tif_channel_names(
+    pages: List[TiffPage],
+    ome_root: Union[None, ElementTree.Element],
+    n_channels: int
+) -> List[str]:
+    """Parse channel names from a TIF file."""
+
+    # Try to parse QPTIFF metadata
+    logger.info("Parsing QPTIFF metadata")
+    channel_names = parse_qptiff_metadata(pages)
+
+    # If no names were found
+    if channel_names is None:
+        logger.info("No channel names found from QPTIFF format")
+
+        # Try to parse OME metadata
+        logger.info("Parsing OME-TIFF metadata")
+        channel_names = parse_ome_metadata(ome_root)
+
+    if channel_names is None:
+        logger.info("No OME-TIFF metadata found")
+
+    elif len(channel_names) > 0:
+        logger.info("Parsed channel names")
+        for cname in channel_names:
+            logger.info(cname)
+
+    # Fallback if metadata was not parsed appropriately
+    if channel_names is None or len(channel_names) != n_channels:
+
+        logger.info("Falling back to numerically indexed channels")
+
+        # The channels are just named numerically (1-indexed)
+        channel_names = [
+            str(ix + 1)
+            for ix in range(n_channels)
+        ]
+
+    return channel_names
+
+
+def parse_qptiff_metadata(pages: List[TiffPage]) -> Union[None, List[str]]:
+    """Parse channel names from QPTIFF."""
+
+    channel_names = [
+        parse_qptiff_metadata_page(page)
+        for page in pages
+    ]
+
+    # If metadata could not be parsed, return None
+    for cn in channel_names:
+        if cn is None:
+            return None
+
+    return channel_names
+
+
+def parse_qptiff_metadata_page(page: TiffPage) -> Union[str, None]:
+    """Parse a single channel name from QPTIFF."""
+
+    # Catch errors when there is no page.description
+    if not hasattr(page, "description"):
+        return None
+
+    # Parse the XML
+    try:
+        dat = ElementTree.fromstring(page.description)
+    except ElementTree.ParseError:
+        logger.info("Could not parse XML from file")
+        return None
+
+    # Try different keywords
+    for kw in [
+        "Biomarker",
+        "Name"
+    ]:
+        elem = dat.find(kw)
+        if elem is not None:
+            return elem.text
+
+
+def _parse_ome_xml(ome_metadata: Union[None, str]) -> Union[None, ElementTree.Element]:
+    """Try to parse the OME-XML metadata from a TIFF file."""
+
+    if ome_metadata is None:
+        return None
+
+    # Parse the metadata
+    try:
+        return ElementTree.fromstring(ome_metadata)
+    except ElementTree.ParseError:
+        logger.info("Could not parse XML from file")
+        return None
+
+
+def parse_ome_metadata(root: Union[None, ElementTree.Element]) -> Union[None, List[str]]:
+    """Parse channel names from OME-TIFF."""
+
+    if root is None:
+        return
+
+    # Try to get the channel names using the OME schema
+    channel_names = [
+        elem.attrib["Name"]
+        for elem in root.iter(f"{OME_NS}Channel")
+        if elem.attrib.get("Name") is not None
+    ]
+    if len(channel_names) > 0:
+        return channel_names
+
+    # Fall back to any list of Names
+    return _find_name_list(root)
+
+
+def _find_name_list(elem: ElementTree.Element) -> Union[None, List[str]]:
+    names = [
+        ch.attrib["Name"]
+        for ch in elem
+        if ch.attrib.get("Name") is not None
+    ]
+    if len(names) > 0:
+        return names
+    for ch in elem:
+        names = _find_name_list(ch)
+        if names is not None:
+            return names
+
+
+main()
@@ -0,0 +1,175 @@
+#!/usr/local/bin/python3
+
+from pathlib import Path
+from spatialdata.models import TableModel
+from zipfile import ZipFile, ZIP_STORED
+import anndata as ad
+import json
+import logging
+import numpy as np
+import pandas as pd
+import shutil
+import spatialdata
+import zarr
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+
+def read_table(fp: str, instance_key="${params.instance_key}") -> TableModel:
+    """
+    Read in the tablular elements of the spatial data
+    and convert to a TableModel object.
+    Must stay identical to read_table in spatialdata.py, so that the new table
+    has the same instance key as the labels in the store (see tests/test_update_table.py).
+    """
+    logger.info(f"Reading in {fp} as AnnData")
+    adata = ad.read_h5ad(fp)
+    adata.obs["region"] = "cell_boundaries"
+    adata.obs["region"] = adata.obs["region"].astype("category")
+
+    logger.info(f"Using instance_key={instance_key}")
+
+    # Make sure that the instance key is present in obs
+    if not instance_key in adata.obs.columns:
+        raise ValueError(f"Instance key {instance_key} not found in obs")
+
+    # The label images need positive integer IDs for each cell
+    if not (
+        pd.api.types.is_integer_dtype(adata.obs[instance_key])
+        and adata.obs[instance_key].min() > 0
+    ):
+        logger.info(f"Values of {instance_key} are not positive integers, adding label_id")
+        adata.obs["label_id"] = np.arange(1, adata.n_obs + 1, dtype="uint32")
+        instance_key = "label_id"
+        logger.info(f"Using instance_key={instance_key}")
+
+    return TableModel.parse(
+        adata,
+        region="cell_boundaries",
+        region_key="region",
+        instance_key=instance_key
+    )
+
+
+def match_cells(table: ad.AnnData, zarr_zip: str, prefix: str) -> ad.AnnData:
+    """
+    Put the rows of the new table in the same order as the table in the store,
+    since the labels, shapes and spatial index all refer to those cells.
+    """
+
+    store = zarr.ZipStore(zarr_zip, mode="r")
+    obs = ad.read_zarr(zarr.open_group(store, mode="r", path=f"{prefix}/tables/table")).obs
+    store.close()
+
+    key = "${params.instance_key}"
+    old_ids = obs[key].astype(str).values
+    new_ids = pd.Index(table.obs[key].astype(str).values)
+
+    if len(old_ids) != len(new_ids) or not new_ids.isin(old_ids).all():
+        raise ValueError(
+            f"The cells in the new table ({len(new_ids):,}) do not match "
+            f"the cells in {zarr_zip} ({len(old_ids):,})"
+        )
+
+    if not (new_ids == old_ids).all():
+        logger.info("Reordering the new table to match the existing store")
+        table = table[new_ids.get_indexer(old_ids)].copy()
+
+        # Integer IDs added by read_table follow the row order
+        if "label_id" in table.obs.columns:
+            table.obs["label_id"] = obs["label_id"].values
+
+    return table
+
+
+def main(
+    anndata="${anndata}",
+    zarr_zip="${zarr_zip}",
+    output_fp="spatialdata.zarr.zip",
+    prefix="spatialdata.zarr",
+    mirror={"tables": "table"}
+):
+    """
+    Replace the table of an existing SpatialData store (zip archive),
+    leaving the image, labels and shapes untouched.
+    """
+
+    # Read the kwargs which were saved in the store by spatialdata.py,
+    # which also consolidates the metadata that is updated for the new table
+    with ZipFile(zarr_zip) as zf:
+        kwargs_name = f"{prefix}/spatialdata.kwargs.json"
+        for name in [kwargs_name, f"{prefix}/zmetadata"]:
+            if name not in zf.namelist():
+                raise ValueError(f"{zarr_zip} does not contain {name}, it must be rebuilt")
+        kwargs = json.loads(zf.read(kwargs_name))
+
+    # Read in the new table, with the cells in the same order as the store
+    table = read_table(anndata)
+    table = match_cells(table, zarr_zip, prefix)
+
+    # Write the new table to a temporary store
+    tmp_path = Path("table_update.zarr")
+    logger.info(f"Writing the new table to {tmp_path}")
+    spatialdata.SpatialData(tables=dict(table=table)).write(tmp_path)
+    with open(tmp_path / "zmetadata") as f:
+        table_metadata = json.load(f)["metadata"]
+
+    # Update the kwargs for the new table
+    kwargs["init_gene"] = table.var_names[0]
+    with open("spatialdata.kwargs.json", "w") as f:
+        json.dump(kwargs, f, indent=4)
+
+    # Paths in the archive which are replaced
+    replaced = [
+        f"{prefix}/{group}/"
+        for group in list(mirror.keys()) + list(mirror.values())
+    ]
+
+    logger.info(f"Writing {output_fp}")
+    n_copied = 0
+    with ZipFile(zarr_zip) as zin, ZipFile(output_fp, "w", compression=ZIP_STORED, allowZip64=True) as zout:
+
+        # Copy everything except the table and the metadata
+        for info in zin.infolist():
+            if any(info.filename.startswith(path) for path in replaced):
+                continue
+            elif info.filename == f"{prefix}/zmetadata":
+                zmetadata = json.loads(zin.read(info))
+            elif info.filename == kwargs_name:
+                zout.writestr(info, json.dumps(kwargs, indent=4))
+            else:
+                with zin.open(info) as src, zout.open(info, "w") as dest:
+                    shutil.copyfileobj(src, dest)
+                n_copied += 1
+
+        # Add the files of the new table, under both of the mirrored names
+        # (zip entries cannot share their data, so the mirror is stored twice)
+        for file in sorted((tmp_path / "tables").rglob("*")):
+            if not file.is_file():
+                continue
+            parts = file.relative_to(tmp_path).parts
+            for group in [parts[0], mirror[parts[0]]]:
+                zout.write(file, Path(prefix, group, *parts[1:]).as_posix())
+
+        # Replace the metadata of the table in the consolidated metadata
+        zmetadata["metadata"] = {
+            **{
+                key: val
+                for key, val in zmetadata["metadata"].items()
+                if not key.startswith("tables/")
+            },
+            **{
+                key: val
+                for key, val in table_metadata.items()
+                if key.startswith("tables/")
+            }
+        }
+        zout.writestr(f"{prefix}/zmetadata", json.dumps(zmetadata, indent=4))
+
+    logger.info(f"Copied {n_copied:,} files from {zarr_zip}")
+    shutil.rmtree(tmp_path)
+
+
+main()
@@ -0,0 +1,25 @@
+import ast
+from pathlib import Path
+
+templates_dir = Path(__file__).parent.parent / "templates"
+
+
+def load_template(name: str, **values) -> dict:
+    """
+    Load the functions and classes of a Nextflow template, without running main().
+    Placeholders such as ${params.instance_key} are filled in from `values`,
+    while any others are left as they are (they are only used in string literals).
+    """
+    source = (templates_dir / name).read_text()
+    for key, value in values.items():
+        source = source.replace("${" + key + "}", str(value))
+
+    tree = ast.parse(source)
+    tree.body = [
+        node for node in tree.body
+        if not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+                and getattr(node.value.func, "id", None) == "main")
+    ]
+    namespace = {}
+    exec(compile(tree, str(templates_dir / name), "exec"), namespace)
+    return namespace
@@ -0,0 +1,72 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from tests.template_loader import load_template
+
+
+class TestRobustSketch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.template = load_template("leiden.py")
+        except ImportError as e:
+            raise unittest.SkipTest(f"Missing dependency of the leiden template: {e}")
+
+    def make_frame(self, n_rows=20000) -> pd.DataFrame:
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame(
+            dict(
+                CD3=rng.lognormal(2, 1, n_rows),
+                CD8=rng.normal(100, 15, n_rows),
+                DAPI=rng.gamma(2, 50, n_rows),
+                # Zero IQR: the same value in every cell, or in most cells
+                empty=np.full(n_rows, 7.0),
+                sparse=np.where(rng.random(n_rows) < 0.9, 0.0, rng.exponential(10, n_rows))
+            ),
+            index=pd.RangeIndex(n_rows, name="object_id")
+        )
+        return df
+
+    def test_quantiles(self):
+        df = self.make_frame()
+        sketch = self.template["QuantileSketch"](df.shape[1])
+        for start in range(0, df.shape[0], 3000):
+            chunk = self.template["QuantileSketch"](df.shape[1])
+            chunk.update(df.values[start:start + 3000])
+            sketch.merge(chunk)
+
+        # Each estimate is within the quantiles q +/- 0.002 of the column
+        for q in [0.25, 0.5, 0.75]:
+            estimate = sketch.quantile(q)
+            lower, upper = df.quantile(q - 0.002).values, df.quantile(q + 0.002).values
+            self.assertTrue(np.all((estimate >= lower - 1e-9) & (estimate <= upper + 1e-9)), (q, estimate))
+
+    def test_stream_robust_scale(self):
+        df = self.make_frame()
+        expected = self.template["scale_intensities"](df, "robust", clip_lower=-3, clip_upper=3)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            df.to_csv(Path(tmp) / "input.csv")
+            keep_cols = self.template["stream_robust_scale"](
+                str(Path(tmp) / "input.csv"),
+                str(Path(tmp) / "scaled.csv"),
+                clip_lower=-3,
+                clip_upper=3,
+                chunksize=3000
+            )
+            scaled = pd.read_csv(Path(tmp) / "scaled.csv", index_col=0)
+
+        # The columns without any spread are dropped, as in memory
+        self.assertEqual(keep_cols, ["CD3", "CD8", "DAPI"])
+        self.assertEqual(keep_cols, expected.dropna(axis=1).columns.tolist())
+
+        self.assertEqual(scaled.shape, df.shape)
+        np.testing.assert_allclose(scaled[keep_cols].values, expected[keep_cols].values, atol=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
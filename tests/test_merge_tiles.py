@@ -0,0 +1,93 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from tests.template_loader import load_template
+
+
+def square(cy: float, cx: float, r: float) -> dict:
+    """GeoJSON polygon of a square cell, in (x, y) pixel coordinates."""
+    return dict(
+        type="Polygon",
+        coordinates=[[[cx - r, cy - r], [cx + r, cy - r], [cx + r, cy + r], [cx - r, cy + r], [cx - r, cy - r]]]
+    )
+
+
+class TestMergeTiles(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.plan_tiles = load_template("plan_tiles.py")
+        try:
+            cls.merge_tiles = load_template("merge_tiles.py")
+        except ImportError as e:
+            raise unittest.SkipTest(f"Missing dependency of the merge_tiles template: {e}")
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def plan(self) -> dict:
+        with open("tiff_metadata.json", "w") as f:
+            json.dump(dict(axes="CYX", shape=[3, 100, 200]), f)
+        self.plan_tiles["main"](metadata="tiff_metadata.json", tile_size="100", overlap="20")
+        with open("tiles.json") as f:
+            return json.load(f)
+
+    def test_plan_tiles(self):
+        layout = self.plan()
+        self.assertEqual(layout["shape"], [100, 200])
+        self.assertEqual(
+            [(tile["name"], tile["core"], tile["bounds"]) for tile in layout["tiles"]],
+            [
+                ("tile_000000_000000", [0, 0, 100, 100], [0, 0, 100, 120]),
+                ("tile_000000_000100", [0, 100, 100, 200], [0, 80, 100, 200])
+            ]
+        )
+
+    def test_merge_tiles(self):
+        layout = self.plan()
+
+        # The cells detected in each tile (with its halo), by ID: (y, x)
+        tile_cells = [
+            dict(a=(50, 30), seam=(20, 100), halo=(80, 85)),
+            # The same cell on the seam one pixel apart, and again the cell in the halo
+            # (which this tile does not own, since its centroid is outside of the margin)
+            dict(b=(50, 170), seam2=(20, 101), halo2=(80, 85))
+        ]
+        for tile, cells in zip(layout["tiles"], tile_cells):
+            with gzip.open(f"{tile['name']}.cells.geo.json.gz", "wt") as f:
+                json.dump(
+                    [
+                        dict(type="Feature", id=cell_id, geometry=square(cy, cx, 5), properties=dict())
+                        for cell_id, (cy, cx) in cells.items()
+                    ],
+                    f
+                )
+            pd.DataFrame({
+                "Object ID": list(cells.keys()),
+                "Centroid X µm": [cx for cy, cx in cells.values()]
+            }).to_csv(f"{tile['name']}.measurements.csv.gz", index=False)
+
+        self.merge_tiles["main"](layout="tiles.json", iou_threshold="0.5")
+
+        with gzip.open("cells.geo.json.gz", "rt") as f:
+            features = json.load(f)
+        measurements = pd.read_csv("measurements.csv.gz")
+
+        # Each cell is kept once, from the first tile which owns it
+        self.assertEqual([feature["id"] for feature in features], ["a", "seam", "halo", "b"])
+        self.assertEqual(measurements["Object ID"].tolist(), ["a", "seam", "halo", "b"])
+        self.assertEqual(measurements["Centroid X µm"].tolist(), [30, 100, 85, 170])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import json
+import math
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from tests.template_loader import load_template
+
+
+class TestPreflight(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.template = load_template(
+            "preflight.py",
+            **{
+                "params.cluster_by": "Cell.Mean",
+                "params.cluster_n_neighbors": 15,
+                "params.scaling": "robust",
+                "params.spatialdata_cpus": 4,
+                "params.zarr_chunk_bytes": 1 << 20
+            }
+        )
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+        with open("tiff_metadata.json", "w") as f:
+            json.dump(dict(shape=[3, 1000, 2000], n_channels=3, dtype="uint16"), f)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def write_table(self, fp: str, n_rows: int):
+        pd.DataFrame({
+            "Object ID": [f"cell_{i}" for i in range(n_rows)],
+            "Cell: DAPI: Mean": range(n_rows),
+            "Cell: CD3: Mean": range(n_rows),
+            "Nucleus: DAPI: Mean": range(n_rows),
+            "Cell: DAPI: Max": range(n_rows)
+        }).to_csv(fp, index=False)
+
+    def run_preflight(self, measurements_csv: str, memory_budget: int) -> dict:
+        self.template["main"](
+            metadata="tiff_metadata.json",
+            measurements_csv=measurements_csv,
+            memory_budget=str(memory_budget),
+            output_fp="preflight.json"
+        )
+        with open("preflight.json") as f:
+            return json.load(f)
+
+    def test_sample_table(self):
+        # Small enough to be read in full
+        self.write_table("small.csv", 1000)
+        columns, n_rows = self.template["sample_table"]("small.csv")
+        self.assertEqual(columns[:2], ["Object ID", "Cell: DAPI: Mean"])
+        self.assertEqual(n_rows, 1000)
+
+        # Only the first block is read, and the rest extrapolated
+        self.write_table("large.csv.gz", 500_000)
+        self.assertGreater(os.path.getsize("large.csv.gz"), 1 << 20)
+        columns, n_rows = self.template["sample_table"]("large.csv.gz")
+        self.assertEqual(len(columns), 5)
+        self.assertAlmostEqual(n_rows / 500_000, 1, delta=0.05)
+
+    def test_count_features(self):
+        self.write_table("measurements.csv", 10)
+        columns, _ = self.template["sample_table"]("measurements.csv")
+        self.assertEqual(self.template["count_features"](columns, "Cell.Mean"), 2)
+        # Falls back to all of the intensity columns
+        self.assertEqual(self.template["count_features"](columns, "Cytoplasm.Mean"), 4)
+
+    def test_switch_to_sketch(self):
+        self.write_table("measurements.csv", 1000)
+
+        # The in-memory estimate (with headroom) does not fit
+        budget = 600 << 20
+        leiden = self.run_preflight("measurements.csv", budget)["stages"]["leiden"]
+        self.assertGreater(leiden["in_memory"] * self.template["HEADROOM"], budget)
+        self.assertEqual(leiden["scaling"], "robust_sketch")
+        self.assertEqual(leiden["mode"], "streaming")
+        self.assertLess(leiden["streaming"], leiden["in_memory"])
+        # The request is capped at the memory available
+        self.assertEqual(leiden["memory"], budget)
+
+    def test_keep_in_memory(self):
+        self.write_table("measurements.csv", 1000)
+
+        output = self.run_preflight("measurements.csv", 8 << 30)
+        self.assertEqual(output["n_cells"], 1000)
+        self.assertEqual(output["n_features"], 2)
+
+        leiden = output["stages"]["leiden"]
+        self.assertEqual(leiden["scaling"], "robust")
+        self.assertEqual(leiden["mode"], "in_memory")
+        self.assertEqual(leiden["memory"], math.ceil(leiden["in_memory"] * self.template["HEADROOM"]))
+        self.assertEqual(sorted(output["stages"]), ["leiden", "spatialdata", "split"])
+
+    def test_no_budget(self):
+        self.write_table("measurements.csv", 1000)
+
+        # Without a memory limit, the estimates are only reported
+        output = self.run_preflight("measurements.csv", 0)
+        self.assertIsNone(output["memory_budget"])
+        self.assertEqual(output["stages"]["leiden"]["scaling"], "robust")
+
+    def test_measurement_only(self):
+        output = self.run_preflight("", 8 << 30)
+        self.assertEqual(list(output["stages"]), ["measurement"])
+
+        # The image, plus the masks and outlines of each pixel
+        measurement = output["stages"]["measurement"]
+        self.assertEqual(
+            measurement["in_memory"],
+            self.template["BYTES_PER_PROCESS"]
+            + 3 * 1000 * 2000 * 2
+            + 1000 * 2000 * self.template["BYTES_PER_MASK_PIXEL"]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
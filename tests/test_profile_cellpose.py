@@ -0,0 +1,33 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from tifffile import imwrite
+
+from bin.profile_cellpose import count_tiles, profile
+
+
+class TestProfileCellpose(unittest.TestCase):
+    def test_count_tiles(self):
+        self.assertEqual(count_tiles(200, 200), 1)
+        self.assertEqual(count_tiles(224, 1000), 6)
+        self.assertEqual(count_tiles(1000, 1000), 36)
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            imwrite(Path(tmp) / "image.tiff", np.zeros((2, 500, 300), dtype="uint16"), photometric="minisblack")
+            (Path(tmp) / "notes.txt").write_text("not an image")
+
+            stats = profile([sys.executable, "-c", "pass"], Path(tmp), batch_size=4, cpus=2)
+
+        self.assertEqual(stats["images"], ["image.tiff"])
+        self.assertEqual(stats["n_pixels"], 500 * 300)
+        self.assertEqual(stats["n_tiles"], count_tiles(500, 300))
+        self.assertEqual(stats["batch_size"], 4)
+        self.assertGreater(stats["peak_rss_bytes"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+
+from tests.template_loader import load_template
+
+
+class TestRasterizeLazy(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.template = load_template("spatialdata.py")
+        except ImportError as e:
+            raise unittest.SkipTest(f"Missing dependency of the spatialdata template: {e}")
+
+    def test_chunk_size(self):
+        from shapely import Point
+
+        # Overlapping circles, so that the pixels they share depend on the order they are burned in
+        rng = np.random.default_rng(0)
+        centers = rng.uniform(20, 480, size=(300, 2))
+        geoms = np.array([Point(x, y).buffer(r) for (x, y), r in zip(centers, rng.uniform(5, 25, 300))])
+        values = np.arange(1, len(geoms) + 1, dtype="uint32")
+
+        rasterize_lazy = self.template["rasterize_lazy"]
+        labels = [
+            rasterize_lazy(
+                geoms,
+                (500, 500),
+                ((chunk,) * (500 // chunk) + ((500 % chunk,) if 500 % chunk else ()),) * 2,
+                values=values,
+                dtype="uint32"
+            ).compute()
+            for chunk in [64, 500]
+        ]
+
+        # Both match burning in all of the shapes at once, in input order
+        full_frame = self.template["rasterize"](
+            zip(geoms, values),
+            fill=0,
+            out_shape=(500, 500),
+            all_touched=True,
+            dtype="uint32"
+        )
+
+        self.assertGreater(len(np.unique(labels[0])), 250)
+        self.assertTrue(np.array_equal(labels[0], labels[1]))
+        self.assertTrue(np.array_equal(labels[0], full_frame))
+
+
+if __name__ == '__main__':
+    unittest.main()
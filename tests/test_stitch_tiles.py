@@ -0,0 +1,104 @@
+import os
+import json
+import tempfile
+import unittest
+
+import numpy as np
+from tifffile import TiffFile, imwrite
+
+from tests.template_loader import load_template
+
+
+def disk(shape, cy, cx, r):
+    yy, xx = np.ogrid[:shape[0], :shape[1]]
+    return (yy - cy) ** 2 + (xx - cx) ** 2 <= r ** 2
+
+
+class TestStitchTiles(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.template = load_template("stitch_tiles.py")
+
+    def make_tiles(self):
+        """
+        Two tiles side by side (cores of 100 x 100 px), overlapping by 20 px, with
+        - a cell in each tile only
+        - a cell crossing the seam between the cores, found by both tiles
+        - a cell inside the overlap, found by both tiles (one pixel apart)
+        """
+        shape = (100, 200)
+        cells = dict(
+            left=disk(shape, 50, 30, 6),
+            right=disk(shape, 50, 170, 6),
+            seam=disk(shape, 20, 100, 6),
+            overlap=disk(shape, 80, 92, 5)
+        )
+        tiles = []
+        for name, core, bounds in [
+            ("tile_0", [0, 0, 100, 100], [0, 0, 100, 120]),
+            ("tile_1", [0, 100, 100, 200], [0, 80, 100, 200])
+        ]:
+            y0, x0, y1, x1 = bounds
+            masks = np.zeros(shape, dtype="uint16")
+            for ix, (kw, cell) in enumerate(cells.items(), 1):
+                if kw == "overlap" and name == "tile_1":
+                    cell = np.roll(cell, 1, axis=1)
+                masks[cell] = ix + (10 if name == "tile_1" else 0)
+            tiles.append((dict(name=name, core=core, bounds=bounds), masks[y0:y1, x0:x1]))
+        return shape, cells, tiles
+
+    def test_stitch_tile(self):
+        shape, cells, tiles = self.make_tiles()
+        masks = np.zeros(shape, dtype="uint32")
+        areas = [0]
+        counts = [
+            self.template["stitch_tile"](masks, areas, tile_masks, tile, margin=10, iou_threshold=0.5)
+            for tile, tile_masks in tiles
+        ]
+
+        # Both tiles own the cells on the seam and in the overlap,
+        # and the copies from the second tile are dropped as duplicates
+        self.assertEqual([c["owned"] for c in counts], [3, 3])
+        self.assertEqual([c["duplicate"] for c in counts], [0, 2])
+        self.assertEqual([c["cut"] for c in counts], [0, 0])
+
+        # Each cell is found once, with consecutive IDs
+        self.assertEqual(len(areas) - 1, 4)
+        self.assertEqual(sorted(np.unique(masks)), [0, 1, 2, 3, 4])
+        for kw, cell in cells.items():
+            labels = np.unique(masks[cell])
+            self.assertEqual(len(labels), 1, kw)
+            self.assertTrue(np.array_equal(masks == labels[0], cell), kw)
+
+    def test_main(self):
+        shape, cells, tiles = self.make_tiles()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                for tile, tile_masks in tiles:
+                    imwrite(f"{tile['name']}_labels.tiff", tile_masks)
+                with open("tiles.json", "w") as f:
+                    json.dump(dict(shape=list(shape), overlap=20, tiles=[tile for tile, _ in tiles]), f)
+
+                self.template["main"](layout="tiles.json", iou_threshold="0.5", tile_size=64)
+
+                with TiffFile("stitched_labels.tiff") as tif:
+                    self.assertTrue(tif.pages[0].is_tiled)
+                    labels = tif.asarray()
+                with open("stitched_labels.json") as f:
+                    metadata = json.load(f)
+                self.assertEqual(sorted(os.listdir(".")), [
+                    "stitched_labels.json", "stitched_labels.tiff", "tile_0_labels.tiff", "tile_1_labels.tiff", "tiles.json"
+                ])
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(labels.shape, shape)
+        self.assertEqual(metadata["n_cells"], 4)
+        self.assertEqual(metadata["duplicates"], 2)
+        self.assertEqual(sum(len(np.unique(labels[cell])) for cell in cells.values()), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
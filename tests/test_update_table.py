@@ -0,0 +1,83 @@
+import ast
+import tempfile
+import unittest
+from pathlib import Path
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+
+from tests.template_loader import load_template, templates_dir
+
+
+def function_body(name: str, template: str) -> str:
+    """The code of a function in a template, without its docstring."""
+    tree = ast.parse((templates_dir / template).read_text())
+    func = next(node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == name)
+    return ast.dump(ast.Module(body=func.body[1:], type_ignores=[]))
+
+
+class TestUpdateTable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.template = load_template("update_table.py", **{"params.instance_key": "object_id"})
+        except ImportError as e:
+            raise unittest.SkipTest(f"Missing dependency of the update_table template: {e}")
+
+    def test_read_table_in_sync(self):
+        self.assertEqual(
+            function_body("read_table", "update_table.py"),
+            function_body("read_table", "spatialdata.py")
+        )
+
+    def write_h5ad(self, fp: Path, object_ids: list):
+        adata = ad.AnnData(
+            X=np.arange(len(object_ids) * 2, dtype="float32").reshape(-1, 2),
+            obs=pd.DataFrame(dict(object_id=object_ids), index=[str(ix) for ix in range(len(object_ids))]),
+            var=pd.DataFrame(index=["CD3", "CD8"])
+        )
+        adata.write_h5ad(fp)
+
+    def write_store(self, tmp: Path, object_ids: list) -> str:
+        """Zip up a store holding the table of the cells, as written by spatialdata.py."""
+        import spatialdata
+        import zarr
+
+        self.write_h5ad(tmp / "old.h5ad", object_ids)
+        table = self.template["read_table"](str(tmp / "old.h5ad"))
+        spatialdata.SpatialData(tables=dict(table=table)).write(tmp / "spatialdata.zarr")
+
+        zarr_zip = str(tmp / "spatialdata.zarr.zip")
+        with zarr.ZipStore(zarr_zip, mode="w") as dest:
+            zarr.copy_store(zarr.DirectoryStore(str(tmp)), dest, source_path="spatialdata.zarr", dest_path="spatialdata.zarr")
+        return zarr_zip
+
+    def test_match_cells(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            zarr_zip = self.write_store(tmp, ["a", "b", "c", "d"])
+
+            # The new table lists the same cells in another order
+            self.write_h5ad(tmp / "new.h5ad", ["c", "a", "d", "b"])
+            table = self.template["read_table"](str(tmp / "new.h5ad"))
+            table = self.template["match_cells"](table, zarr_zip, "spatialdata.zarr")
+
+            # The cells are in the order of the store, with the label IDs of the store
+            self.assertEqual(table.obs["object_id"].tolist(), ["a", "b", "c", "d"])
+            self.assertEqual(table.obs["label_id"].tolist(), [1, 2, 3, 4])
+            self.assertEqual(table.X[:, 0].tolist(), [2, 6, 0, 4])
+
+    def test_match_cells_mismatch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            zarr_zip = self.write_store(tmp, ["a", "b", "c"])
+
+            self.write_h5ad(tmp / "new.h5ad", ["a", "b", "e"])
+            table = self.template["read_table"](str(tmp / "new.h5ad"))
+            with self.assertRaises(ValueError):
+                self.template["match_cells"](table, zarr_zip, "spatialdata.zarr")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from tifffile import TiffFile
+
+from bin.write_labels import write_labels
+
+
+class TestWriteLabels(unittest.TestCase):
+    def test_write_labels(self):
+        masks = np.zeros((600, 700), dtype="uint32")
+        masks[10:20, 10:20] = 1
+        masks[100:150, 600:650] = 300
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output_fp = Path(tmp) / "image_labels.tiff"
+            metadata = write_labels(masks, output_fp, dict(diameter="30"))
+
+            with TiffFile(output_fp) as tif:
+                page = tif.pages[0]
+                self.assertTrue(page.is_tiled)
+                self.assertEqual(page.compression, 8)
+                labels = tif.asarray()
+            with open(Path(tmp) / "image_labels.json") as handle:
+                self.assertEqual(json.load(handle), metadata)
+
+        # The IDs are kept, in the smallest type which holds them
+        self.assertEqual(labels.dtype, np.uint16)
+        self.assertTrue(np.array_equal(labels, masks))
+        self.assertEqual(metadata["n_cells"], 2)
+        self.assertEqual(metadata["max_label"], 300)
+        self.assertEqual(metadata["parameters"], dict(diameter="30"))
+
+
+if __name__ == '__main__':
+    unittest.main()